@@ -4,8 +4,30 @@
 # Terms of use: MIT license. See COPYING.txt.
 # Approximate version: 1.00, 2025-05-25
 
+# This file can also be imported as a module. See fingerprint() and
+# hash_many().
+
 import sys
+import io
+import os
 import struct
+import copy
+import hashlib
+import mmap
+import multiprocessing
+import zipfile
+import tarfile
+import zlib
+import stat
+import signal
+import threading
+import socketserver
+import concurrent.futures
+import itertools
+import collections
+import sqlite3
+import time
+import json
 
 class crc32_factory:
     def __init__(self):
@@ -15,6 +37,24 @@ class crc32_factory:
             0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
             0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c ]
 
+        # x2n_tab[n] is x^(2^n), modulo the CRC polynomial.
+        self.x2n_tab = []
+        p = 1 << 30
+        self.x2n_tab.append(p)
+        for n in range(1, 32):
+            p = multmodp(p, p)
+            self.x2n_tab.append(p)
+
+    # Returns x^(n * 2^k), modulo the CRC polynomial.
+    def x2nmodp(self, n, k):
+        p = 1 << 31
+        while n:
+            if n & 1:
+                p = multmodp(self.x2n_tab[k & 31], p)
+            n >>= 1
+            k += 1
+        return p
+
 class crc32_class:
     def __init__(self, factory):
         self.f = factory
@@ -34,13 +74,190 @@ class crc32_class:
         self.update(data)
         return self.getval()
 
+    # Returns the CRC of the concatenation of two byte sequences, given the
+    # CRC of each, and the length of the second. (Same algorithm as zlib's
+    # crc32_combine().)
+    def combine(self, crc1, crc2, len2):
+        if len2<1:
+            return crc1 ^ crc2
+        return multmodp(self.f.x2nmodp(len2, 3), crc1) ^ crc2
+
+# Multiply a by b, modulo the CRC polynomial.
+def multmodp(a, b):
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m-1))==0:
+                break
+        m >>= 1
+        if b & 1:
+            b = (b >> 1) ^ 0xedb88320
+        else:
+            b >>= 1
+    return p
+
+# Similarity hashing ("sim" digest)
+# The data is split into chunks, using content-defined chunking (a "gear"
+# rolling hash), so that an insertion or deletion only changes the chunks
+# near it. Each chunk is CRC'd, and the set of chunk CRCs is summarized
+# by a MinHash signature: for each of g_sim_k hash functions, the low 16
+# bits of the minimum hash value over all chunks. The fraction of positions
+# at which two signatures agree estimates the similarity (Jaccard index) of
+# the two sets of chunks.
+g_sim_k = 32
+g_sim_min_chunk = 32
+g_sim_max_chunk = 2048
+g_sim_mask = 0xff000000 # Average chunk size about 256 bytes
+g_sim_prime = (1 << 61) - 1
+g_sim_tables = None
+
+# Returns (gear table, list of MinHash (a, b) coefficients). These must
+# never change, or old signatures will be incompatible.
+def get_sim_tables():
+    global g_sim_tables
+    if g_sim_tables is None:
+        gear = []
+        for i in range(256):
+            x = hashlib.md5(b'exehash-gear-%d' % (i)).digest()
+            gear.append((struct.unpack("<L", x[0:4]))[0])
+        coeffs = []
+        for i in range(g_sim_k):
+            x = hashlib.md5(b'exehash-minhash-%d' % (i)).digest()
+            a, b = struct.unpack("<QQ", x)
+            coeffs.append(((a % (g_sim_prime-1)) + 1, b % g_sim_prime))
+        g_sim_tables = (gear, coeffs)
+    return g_sim_tables
+
+# Works like a hashlib object.
+class simhash_class:
+    def __init__(self):
+        self.gear, self.coeffs = get_sim_tables()
+        self.h = 0
+        self.chunk_len = 0
+        self.chunk_crc = 0
+        self.mins = [g_sim_prime] * g_sim_k
+    def add_feature(self, x):
+        mins = self.mins
+        for i in range(g_sim_k):
+            a, b = self.coeffs[i]
+            v = (a*x + b) % g_sim_prime
+            if v < mins[i]:
+                mins[i] = v
+    def update(self, data):
+        gear = self.gear
+        h = self.h
+        chunk_len = self.chunk_len
+        start = 0
+        for i in range(len(data)):
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+            chunk_len += 1
+            if ((h & g_sim_mask)==0 and chunk_len>=g_sim_min_chunk) or \
+                chunk_len>=g_sim_max_chunk:
+                self.add_feature(zlib.crc32(data[start:i+1], self.chunk_crc))
+                self.chunk_crc = 0
+                chunk_len = 0
+                h = 0
+                start = i+1
+        self.chunk_crc = zlib.crc32(data[start:], self.chunk_crc)
+        self.h = h
+        self.chunk_len = chunk_len
+    def hexdigest(self):
+        mins = list(self.mins)
+        if self.chunk_len>0:
+            # Include the final partial chunk, without disturbing our state.
+            saved_mins = self.mins
+            self.mins = mins
+            self.add_feature(self.chunk_crc)
+            self.mins = saved_mins
+        return ''.join(['%04x' % (x & 0xffff) for x in mins])
+
+def parse_sim_digest(val):
+    return tuple([int(val[i:i+4], 16) for i in range(0, len(val), 4)])
+
+# Returns the estimated similarity (0.0 to 1.0) of two parsed signatures.
+def sim_estimate(sig1, sig2):
+    n = 0
+    for i in range(len(sig1)):
+        if sig1[i]==sig2[i]:
+            n += 1
+    return n / len(sig1)
+
+# An index of similarity signatures, using locality-sensitive hashing:
+# Each signature is split into bands, and each band is looked up in a hash
+# table. Only signatures that share at least one band with the query are
+# compared to it.
+class sim_index:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        # Use the widest bands that still find 95% of pairs at the
+        # threshold similarity.
+        self.rows = 1
+        for rows in (2, 4, 8):
+            if 1.0 - (1.0 - threshold**rows)**(g_sim_k//rows) >= 0.95:
+                self.rows = rows
+        self.tables = [{} for i in range(g_sim_k//self.rows)]
+        self.keys = []
+        self.sigs = []
+    def add(self, key, sig):
+        idx = len(self.sigs)
+        self.keys.append(key)
+        self.sigs.append(sig)
+        for b in range(len(self.tables)):
+            band = sig[b*self.rows : (b+1)*self.rows]
+            self.tables[b].setdefault(band, []).append(idx)
+    # Returns a list of (key, similarity) for the indexed signatures that are
+    # at least threshold similar to sig.
+    def query(self, sig):
+        candidates = set()
+        for b in range(len(self.tables)):
+            band = sig[b*self.rows : (b+1)*self.rows]
+            candidates.update(self.tables[b].get(band, ()))
+        matches = []
+        for idx in sorted(candidates):
+            sim = sim_estimate(sig, self.sigs[idx])
+            if sim >= self.threshold:
+                matches.append((self.keys[idx], sim))
+        return matches
+
 class context:
     def __init__(ctx):
+        ctx.crcobj = crc32_class(crc32_factory())
         ctx.opt_uppercase = False
         ctx.opt_wholefile_only = False
         ctx.opt_wholefile_also = False
-        ctx.dict = {}
-        ctx.prev_hash_strat = 0
+        ctx.opt_recurse = False
+        ctx.opt_stdin_list = False
+        ctx.stdin_list_delim = b'\n'
+        ctx.opt_archives = False
+        ctx.opt_sections = False
+        ctx.opt_unordered = False
+        ctx.num_jobs = 1
+        ctx.prefetch_threads = 0 # I/O threads for read-ahead; 0 = none
+        ctx.prefetch_max_bytes = 32*1024*1024 # Per file
+        ctx.server_socket_name = ''
+        ctx.sqlite_filename = ''
+        ctx.opt_dups = False
+        ctx.sim_threshold = None
+        ctx.digest_names = [] # Extra digests, in addition to the CRC
+        ctx.iobuf = bytearray(65536)
+        # A list of dictionaries, in priority order. Each is either a
+        # Python dict, or a compiled_dict.
+        ctx.dicts = []
+        ctx.compile_dict_filename = ''
+        ctx.merge_filename = ''
+        ctx.merge_dict_filename = ''
+        ctx.shard = None # (i, n): process only shard i (1-based) of n
+        ctx.cache_filename = ''
+        ctx.opt_cache_compact = False
+        ctx.opt_cache_refresh = False
+        ctx.cache = None
+        ctx.cachef = None
+        ctx.cache_needs_rewrite = False
+        ctx.opt_stats = False # Collect timing statistics
+        ctx.stats_filename = '' # JSON file to write them to ('' = stderr)
+        ctx.stats = None # A run_stats object, in the main process
 
 class exe_info:
     def __init__(self):
@@ -56,10 +273,30 @@ class file_context:
         fctx.msg = 'ERR'
         fctx.file_id = 'UNK'
         fctx.hash_strat = 0 # 0=none 1=whole file 2=DOSEXE 3=Ext.EXE
+                            # 4=Ext.EXE code sections
         fctx.hash_pos = 0
         fctx.hash_len = 0
+        fctx.hash_regions = [] # list of (pos, len), in hashing order
         fctx.is_dos_exe = False
         fctx.is_ext_exe = False
+        fctx.ext_hdr_pos = 0
+        fctx.digests = [] # list of (name, hex string)
+        fctx.is_extra_wholefile = False # The second result, with -a
+        fctx.hashed = False # True if the hash field has been computed
+        fctx.from_cache = False
+        fctx.cache_key = None
+        fctx.cache_stat = None
+        fctx.bytes_read = 0 # Bytes read by hash_range()
+        fctx.phase_times = None # With --stats: dict of phase -> seconds
+
+    # Returns the main fields of the result, as a dict.
+    def as_dict(fctx):
+        d = {'name': fctx.name_friendly, 'hash': fctx.hash,
+            'csz': fctx.hash_len, 'fsz': fctx.filesize, 't': fctx.ffmt,
+            'm': fctx.msg, 'h': fctx.hash_strat, 'id': fctx.file_id}
+        for name, val in fctx.digests:
+            d[name] = val
+        return d
 
 def detect_and_decode_ext_exe(ctx, fctx, ei):
     if fctx.filesize<66:
@@ -76,6 +313,7 @@ def detect_and_decode_ext_exe(ctx, fctx, ei):
         ext_hdr_pos>(fctx.filesize-4):
         return
 
+    fctx.ext_hdr_pos = ext_hdr_pos
     fctx.inf.seek(ext_hdr_pos, 0)
     tmpbytes3 = fctx.inf.read(4)
     if tmpbytes3[0:2]==b'NE':
@@ -145,15 +383,303 @@ def detect_and_decode_exe(ctx, fctx):
     # If not, treat it as DOS EXE
     decode_dos_exe(ctx, fctx, ei)
 
-def onefile(ctx, fn, force_wholefile):
-    # Make sure we reset this
-    ctx.prev_hash_strat = 0
+# Find the code segments of an NE file. Returns a list of (pos, len), or
+# an empty list if there are none, or something is wrong.
+def find_ne_code_regions(ctx, fctx):
+    regions = []
+    if fctx.ext_hdr_pos+64 > fctx.filesize:
+        return []
+    fctx.inf.seek(fctx.ext_hdr_pos, 0)
+    hdr = fctx.inf.read(64)
+    num_segs = (struct.unpack_from("<H", hdr, 0x1c))[0]
+    segtbl_pos = fctx.ext_hdr_pos + (struct.unpack_from("<H", hdr, 0x22))[0]
+    align_shift = (struct.unpack_from("<H", hdr, 0x32))[0]
+    if align_shift==0:
+        align_shift = 9
+    if align_shift>16:
+        return []
+    if segtbl_pos + 8*num_segs > fctx.filesize:
+        return []
+
+    fctx.inf.seek(segtbl_pos, 0)
+    segtbl = fctx.inf.read(8*num_segs)
+    for i in range(num_segs):
+        sector, seglen, flags = struct.unpack_from("<HHH", segtbl, 8*i)
+        if sector==0:
+            continue # No data in the file
+        if flags & 0x0001:
+            continue # Data segment
+        if seglen==0:
+            seglen = 65536
+        pos = sector << align_shift
+        if pos+seglen > fctx.filesize:
+            return []
+        regions.append((pos, seglen))
+
+    return regions
 
+# Find the code sections of a PE file. Returns a list of (pos, len), or
+# an empty list if there are none, or something is wrong.
+def find_pe_code_regions(ctx, fctx):
+    regions = []
+    if fctx.ext_hdr_pos+24 > fctx.filesize:
+        return []
+    fctx.inf.seek(fctx.ext_hdr_pos+4, 0)
+    coffhdr = fctx.inf.read(20)
+    num_sections = (struct.unpack_from("<H", coffhdr, 2))[0]
+    opthdr_size = (struct.unpack_from("<H", coffhdr, 16))[0]
+    sectbl_pos = fctx.ext_hdr_pos + 24 + opthdr_size
+    if sectbl_pos + 40*num_sections > fctx.filesize:
+        return []
+
+    fctx.inf.seek(sectbl_pos, 0)
+    sectbl = fctx.inf.read(40*num_sections)
+    for i in range(num_sections):
+        raw_size, raw_pos = struct.unpack_from("<LL", sectbl, 40*i+16)
+        characteristics = (struct.unpack_from("<L", sectbl, 40*i+36))[0]
+        # IMAGE_SCN_CNT_CODE or IMAGE_SCN_MEM_EXECUTE
+        if (characteristics & 0x20000020)==0:
+            continue
+        if raw_size==0 or raw_pos==0:
+            continue
+        if raw_pos+raw_size > fctx.filesize:
+            return []
+        regions.append((raw_pos, raw_size))
+
+    return regions
+
+def new_file_context(ctx, fn):
     fctx = file_context(ctx)
     if (len(fn)>2) and (fn[0:2]=='./'):
         fctx.name_friendly = fn[2:]
     else:
         fctx.name_friendly = fn
+    return fctx
+
+# Make the result for the whole-file hash, when the file is read in the
+# same pass as the main hash.
+def make_wholefile_fctx(ctx, fctx, crc, digests):
+    wfctx = copy.copy(fctx)
+    wfctx.inf = None
+    wfctx.hash_strat = 1
+    wfctx.hash_pos = 0
+    wfctx.hash_len = fctx.filesize
+    wfctx.hash_regions = [(0, fctx.filesize)]
+    wfctx.hash = crc
+    wfctx.digests = digests
+    wfctx.is_extra_wholefile = True
+    if fctx.cache_key is not None:
+        wfctx.cache_key = (cache_mode(ctx, True), fctx.cache_key[1])
+    return wfctx
+
+def new_crcobj(ctx):
+    return crc32_class(ctx.crcobj.f)
+
+def new_digest_obj(name):
+    if name=='sim':
+        return simhash_class()
+    return hashlib.new(name)
+
+def new_digest_objs(ctx):
+    return [new_digest_obj(name) for name in ctx.digest_names]
+
+def finish_digests(ctx, digest_objs):
+    return [(ctx.digest_names[i], digest_objs[i].hexdigest()) \
+        for i in range(len(digest_objs))]
+
+# Hash a region of the file (fctx.inf), feeding each chunk to every object
+# in the hashers list. The file is read through a fixed-size buffer, so
+# that memory use doesn't depend on the file size.
+def hash_range(ctx, fctx, pos, length, hashers):
+    inf = fctx.inf
+    phase_times = fctx.phase_times
+    inf.seek(pos, 0)
+    bufview = memoryview(ctx.iobuf)
+    while length>0:
+        if phase_times is not None:
+            t0 = time.perf_counter()
+        n = inf.readinto(bufview[0:min(length, len(ctx.iobuf))])
+        if not n:
+            break
+        if phase_times is not None:
+            t0 = add_phase_time(phase_times, 'read', t0)
+        chunk = bufview[0:n]
+        for h in hashers:
+            h.update(chunk)
+        chunk.release()
+        if phase_times is not None:
+            add_phase_time(phase_times, 'hash', t0)
+        fctx.bytes_read += n
+        length -= n
+    bufview.release()
+
+def regions_are_in_order(fctx):
+    pos = 0
+    for rpos, rlen in fctx.hash_regions:
+        if rpos<pos:
+            return False
+        pos = rpos+rlen
+    return True
+
+def hash_regions(ctx, fctx):
+    crcobj = new_crcobj(ctx)
+    digests = new_digest_objs(ctx)
+    for rpos, rlen in fctx.hash_regions:
+        hash_range(ctx, fctx, rpos, rlen, [crcobj] + digests)
+    fctx.hash = crcobj.getval()
+    fctx.digests = finish_digests(ctx, digests)
+    fctx.hashed = True
+
+# Hash the regions, and also the whole file. Returns the file_context for
+# the whole-file result.
+def hash_regions_and_wholefile(ctx, fctx):
+    if not regions_are_in_order(fctx):
+        # Rare. Just read the file twice.
+        hash_regions(ctx, fctx)
+        crcobj = new_crcobj(ctx)
+        wdigests = new_digest_objs(ctx)
+        hash_range(ctx, fctx, 0, fctx.filesize, [crcobj] + wdigests)
+        return make_wholefile_fctx(ctx, fctx, crcobj.getval(), \
+            finish_digests(ctx, wdigests))
+
+    # Read the file once, from start to end, hashing each region and each
+    # gap between regions separately. Then combine the CRCs to get the
+    # region CRC and the whole-file CRC. Other digests can't be combined,
+    # so the whole-file digests are fed everything.
+    digests = new_digest_objs(ctx)
+    wdigests = new_digest_objs(ctx)
+    crc = 0
+    wcrc = 0
+    pos = 0
+    for rpos, rlen in fctx.hash_regions + [(fctx.filesize, 0)]:
+        if rpos>pos:
+            crcobj = new_crcobj(ctx)
+            hash_range(ctx, fctx, pos, rpos-pos, [crcobj] + wdigests)
+            wcrc = ctx.crcobj.combine(wcrc, crcobj.getval(), rpos-pos)
+        if rlen>0:
+            crcobj = new_crcobj(ctx)
+            hash_range(ctx, fctx, rpos, rlen, \
+                [crcobj] + digests + wdigests)
+            crc = ctx.crcobj.combine(crc, crcobj.getval(), rlen)
+            wcrc = ctx.crcobj.combine(wcrc, crcobj.getval(), rlen)
+        pos = rpos+rlen
+
+    fctx.hash = crc
+    fctx.digests = finish_digests(ctx, digests)
+    fctx.hashed = True
+    return make_wholefile_fctx(ctx, fctx, wcrc, finish_digests(ctx, wdigests))
+
+# Analyze a file that has been opened (fctx.inf), and whose size is known
+# (fctx.filesize), and choose a hashing strategy. fctx.inf must be
+# seekable, but need not be a real file.
+# Sets hash_strat to 0 if there is nothing to hash.
+def analyze_stream(ctx, fctx, force_wholefile):
+    fctx.msg = 'OK' # default
+    fctx.ffmt = 'MISC'
+
+    # Analyze the file
+    detect_and_decode_exe(ctx, fctx)
+
+    # Choose a strategy
+    if force_wholefile:
+        fctx.hash_strat = 1
+        fctx.hash_pos = 0
+        fctx.hash_len = fctx.filesize
+    elif fctx.is_ext_exe:
+        fctx.hash_strat = 3
+        fctx.hash_pos = 60
+        fctx.hash_len = fctx.filesize - fctx.hash_pos
+        if ctx.opt_sections:
+            if fctx.ffmt=='EXE-NE':
+                regions = find_ne_code_regions(ctx, fctx)
+            elif fctx.ffmt=='EXE-PE':
+                regions = find_pe_code_regions(ctx, fctx)
+            else:
+                regions = []
+            if len(regions)>0:
+                fctx.hash_strat = 4
+                fctx.hash_regions = regions
+                fctx.hash_pos = regions[0][0]
+                fctx.hash_len = sum([x[1] for x in regions])
+    elif fctx.is_dos_exe:
+        fctx.hash_strat = 2
+        fctx.hash_pos = fctx.dos_exe_codepos
+        fctx.hash_len = fctx.dos_exe_codesize
+    else:
+        fctx.hash_strat = 1
+        fctx.hash_pos = 0
+        fctx.hash_len = fctx.filesize
+
+    if fctx.hash_strat!=4:
+        fctx.hash_regions = [(fctx.hash_pos, fctx.hash_len)]
+
+    # With strategy 4, the regions need not be contiguous or in order, but
+    # each one has already been checked by find_*_code_regions().
+    if fctx.hash_strat==4:
+        pass
+    elif not (fctx.hash_len>0 and \
+        (fctx.hash_pos+fctx.hash_len <= fctx.filesize)):
+        fctx.hash_strat = 0
+        fctx.codesize = 0
+
+# Analyze a file that has been opened. See analyze_stream().
+def analyze_stream_timed(ctx, fctx, force_wholefile):
+    if fctx.phase_times is not None:
+        t0 = time.perf_counter()
+    analyze_stream(ctx, fctx, force_wholefile)
+    if fctx.phase_times is not None:
+        add_phase_time(fctx.phase_times, 'header', t0)
+
+# Hash a file that has been analyzed. Returns the list of results.
+def hash_stream(ctx, fctx, also_wholefile):
+    results = [fctx]
+
+    if fctx.hash_strat>0:
+        if also_wholefile and fctx.hash_strat>1:
+            results.append(hash_regions_and_wholefile(ctx, fctx))
+        else:
+            hash_regions(ctx, fctx)
+
+    return results
+
+# Analyze and hash a file that has been opened. See analyze_stream().
+def onestream(ctx, fctx, force_wholefile, also_wholefile):
+    analyze_stream_timed(ctx, fctx, force_wholefile)
+    return hash_stream(ctx, fctx, also_wholefile)
+
+# Analyze and hash one file. Does not print anything, and does not consult
+# the dictionary, so it can safely be run in a worker process.
+# Returns a list of file_context objects: the main result, and, if
+# also_wholefile is set and it makes a difference, the whole-file result.
+def onefile(ctx, fn, force_wholefile, also_wholefile):
+    results, fctx = onefile_start(ctx, fn, force_wholefile, \
+        also_wholefile)
+    if fctx is None:
+        return results
+    return onefile_finish(ctx, fctx, also_wholefile)
+
+# The first part of onefile(): Look in the cache, or else open and analyze
+# the file. Returns (results, None) if the results are already known, or
+# (None, fctx) if the file still needs to be hashed by onefile_finish().
+def onefile_start(ctx, fn, force_wholefile, also_wholefile):
+    fctx = new_file_context(ctx, fn)
+
+    if ctx.cache is not None:
+        if cache_lookup(ctx, fctx, fn, force_wholefile):
+            if not (also_wholefile and fctx.hash_strat>1):
+                return [fctx], None
+            wfctx = new_file_context(ctx, fn)
+            if cache_lookup(ctx, wfctx, fn, True):
+                wfctx.is_extra_wholefile = True
+                return [fctx, wfctx], None
+            # Only partly cached. Start over.
+            fctx = new_file_context(ctx, fn)
+            fctx.cache_key = (cache_mode(ctx, force_wholefile), \
+                wfctx.cache_key[1])
+
+    if ctx.opt_stats:
+        fctx.phase_times = {}
+        t0 = time.perf_counter()
 
     try:
         fctx.inf = open(fn, "rb")
@@ -162,62 +688,1025 @@ def onefile(ctx, fn, force_wholefile):
         fctx.msg = "CANT-READ"
 
     if fctx.isopen:
+        if ctx.cache is not None:
+            fctx.cache_stat = stat_to_cache_stat( \
+                os.fstat(fctx.inf.fileno()))
+
         fctx.inf.seek(0, 2)
         fctx.filesize = fctx.inf.tell()
+        if ctx.opt_stats:
+            add_phase_time(fctx.phase_times, 'open', t0)
 
-        fctx.msg = 'OK' # default
-        fctx.ffmt = 'MISC'
-
-        # Analyze the file
-        detect_and_decode_exe(ctx, fctx)
-
-        # Choose a strategy
-        if force_wholefile:
-            fctx.hash_strat = 1
-            fctx.hash_pos = 0
-            fctx.hash_len = fctx.filesize
-        elif fctx.is_ext_exe:
-            fctx.hash_strat = 3
-            fctx.hash_pos = 60
-            fctx.hash_len = fctx.filesize - fctx.hash_pos
-        elif fctx.is_dos_exe:
-            fctx.hash_strat = 2
-            fctx.hash_pos = fctx.dos_exe_codepos
-            fctx.hash_len = fctx.dos_exe_codesize
-        else:
-            fctx.hash_strat = 1
-            fctx.hash_pos = 0
-            fctx.hash_len = fctx.filesize
-
-        # Compute the hash
-        if fctx.hash_len>0 and \
-            (fctx.hash_pos+fctx.hash_len <= fctx.filesize):
-            fctx.inf.seek(fctx.hash_pos, 0)
-            codeblob = bytearray(fctx.inf.read(fctx.hash_len))
-            fctx.hash = ctx.crcobj.oneshot(codeblob)
-        else:
-            fctx.hash_strat = 0
-            fctx.codesize = 0
+        analyze_stream_timed(ctx, fctx, force_wholefile)
+        return None, fctx
 
+    fctx.hash_strat = 0
+    return [fctx], None
+
+# The second part of onefile(): Hash the file, and close it.
+def onefile_finish(ctx, fctx, also_wholefile):
+    results = hash_stream(ctx, fctx, also_wholefile)
+    fctx.inf.close()
+    fctx.inf = None
+    return results
+
+# Errors that can happen when reading a damaged or unsupported archive.
+g_archive_errors = (OSError, EOFError, RuntimeError, ValueError, \
+    zlib.error, zipfile.BadZipFile, tarfile.TarError)
+
+# Returns 'zip', 'tar', or '' if the file isn't an archive we support.
+def get_archive_type(fn):
+    try:
+        inf = open(fn, "rb")
+        sig = inf.read(4)
+        inf.close()
+    except OSError:
+        return ''
+
+    if sig==b'PK\x03\x04' or sig==b'PK\x05\x06':
+        return 'zip'
+    if sig[0:2]==b'MZ' or sig[0:2]==b'ZM':
+        return ''
+    if tarfile.is_tarfile(fn):
+        return 'tar'
+    return ''
+
+# Like get_archive_type(), but a file with a valid cache entry is known not
+# to be an archive, and is not opened.
+def get_input_archive_type(ctx, fn, force_wholefile):
+    if ctx.cache is not None:
+        if cache_lookup(ctx, new_file_context(ctx, fn), fn, force_wholefile):
+            return ''
+    return get_archive_type(fn)
+
+# Hash one archive member, reading it straight from the decompressor.
+def onemember(ctx, name, opener, filesize, force_wholefile, also_wholefile):
+    fctx = new_file_context(ctx, name)
+
+    try:
+        if ctx.opt_stats:
+            fctx.phase_times = {}
+            t0 = time.perf_counter()
+        fctx.inf = opener()
+        fctx.isopen = True
+        if ctx.opt_stats:
+            add_phase_time(fctx.phase_times, 'open', t0)
+        fctx.filesize = filesize
+        results = onestream(ctx, fctx, force_wholefile, also_wholefile)
         fctx.inf.close()
+    except g_archive_errors:
+        fctx = new_file_context(ctx, name)
+        fctx.msg = "CANT-READ"
+        results = [fctx]
 
-        if fctx.hash in ctx.dict:
-            fctx.file_id = ctx.dict[fctx.hash]
+    fctx.inf = None
+    return results
+
+# Hash each file in a ZIP or TAR archive. The members are reported as
+# "archive.zip/member.exe". Results are not cached.
+def onearchive(ctx, fn, atype, force_wholefile, also_wholefile):
+    results = []
+
+    try:
+        if atype=='zip':
+            with zipfile.ZipFile(fn) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    results += onemember(ctx, fn+'/'+info.filename, \
+                        lambda: zf.open(info), info.file_size, \
+                        force_wholefile, also_wholefile)
+        else:
+            with tarfile.open(fn) as tf:
+                for member in tf:
+                    if not member.isfile():
+                        continue
+                    results += onemember(ctx, fn+'/'+member.name, \
+                        lambda: tf.extractfile(member), member.size, \
+                        force_wholefile, also_wholefile)
+    except g_archive_errors:
+        fctx = new_file_context(ctx, fn)
+        fctx.msg = "BAD-ARCHIVE"
+        results.append(fctx)
+
+    return results
+
+# The cache file is a text file, with one entry per line. Entries are
+# appended as files are hashed. If there are several entries for the same
+# file, the last one wins.
+g_cache_header = '# exehash cache v2'
+
+def stat_to_cache_stat(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+# With -z, a 'z' is added, to record that the file was found not to be an
+# archive. So a cached file does not have to be read to check that.
+def cache_mode(ctx, force_wholefile):
+    if force_wholefile:
+        mode = 'w'
+    elif ctx.opt_sections:
+        mode = 's'
     else:
-        fctx.hash_strat = 0
+        mode = 'c'
+    if ctx.opt_archives:
+        mode += 'z'
+    return mode
+
+def read_cache_file(ctx):
+    ctx.cache = {}
+    if ctx.opt_cache_refresh:
+        return
+
+    try:
+        inf = open(ctx.cache_filename, 'r', encoding='utf8',
+            errors='surrogateescape', newline='\n')
+    except FileNotFoundError:
+        return
+
+    # If the cache was written by a different version, ignore it.
+    if inf.readline().rstrip('\n')!=g_cache_header:
+        inf.close()
+        ctx.cache_needs_rewrite = True
+        return
+
+    for line1 in inf:
+        line = line1.rstrip('\n')
+        if (len(line)==0) or (line[0:1]=='#'):
+            continue
+        ss = line.split('\t', maxsplit=10)
+        if len(ss)<11:
+            continue
+        digests = {}
+        if ss[9]!='-':
+            for item in ss[9].split(','):
+                name, _, val = item.partition('=')
+                digests[name] = val
+        ctx.cache[(ss[0], ss[10])] = ( \
+            (int(ss[1]), int(ss[2]), int(ss[3])), \
+            int(ss[4], base=16), int(ss[5]), ss[6], ss[7], int(ss[8]),
+            digests)
+
+    inf.close()
+
+# If there is a valid cache entry for this file, fill in fctx from it,
+# and return True.
+def cache_lookup(ctx, fctx, fn, force_wholefile):
+    fctx.cache_key = (cache_mode(ctx, force_wholefile), os.path.abspath(fn))
+    if not (fctx.cache_key in ctx.cache):
+        return False
+
+    try:
+        st = stat_to_cache_stat(os.stat(fn))
+    except OSError:
+        return False
+
+    x = ctx.cache[fctx.cache_key]
+    if x[0]!=st:
+        return False
+    if x[5]!=0:
+        for name in ctx.digest_names:
+            if not (name in x[6]):
+                return False
+
+    fctx.from_cache = True
+    fctx.hashed = True
+    fctx.cache_stat = st
+    fctx.filesize = st[0]
+    fctx.hash = x[1]
+    fctx.hash_len = x[2]
+    fctx.ffmt = x[3]
+    fctx.msg = x[4]
+    fctx.hash_strat = x[5]
+    if x[5]!=0:
+        fctx.digests = [(name, x[6][name]) for name in ctx.digest_names]
+    return True
+
+def cache_entry_to_line(key, x):
+    if len(x[6])>0:
+        digests = ','.join(['%s=%s' % (name, x[6][name]) for name in x[6]])
+    else:
+        digests = '-'
+    return '%s\t%d\t%d\t%d\t%08x\t%d\t%s\t%s\t%d\t%s\t%s\n' % ( \
+        key[0], x[0][0], x[0][1], x[0][2], x[1], x[2], x[3], x[4], x[5],
+        digests, key[1])
+
+def open_cache_for_append(ctx):
+    if ctx.opt_cache_refresh or ctx.cache_needs_rewrite:
+        mode = 'w'
+    else:
+        mode = 'a'
+    ctx.cachef = open(ctx.cache_filename, mode, encoding='utf8',
+        errors='surrogateescape', newline='\n')
+    if ctx.cachef.tell()==0:
+        ctx.cachef.write(g_cache_header+'\n')
+
+def cache_add_result(ctx, fctx):
+    if fctx.from_cache or (fctx.cache_key is None) or \
+        (fctx.cache_stat is None):
+        return
+    if '\n' in fctx.cache_key[1]:
+        return
 
+    x = (fctx.cache_stat, fctx.hash, fctx.hash_len, fctx.ffmt, fctx.msg,
+        fctx.hash_strat, dict(fctx.digests))
+    ctx.cache[fctx.cache_key] = x
+    ctx.cachef.write(cache_entry_to_line(fctx.cache_key, x))
+
+# Rewrite the cache file, keeping only the latest entry for each file,
+# and dropping entries for files that have changed or no longer exist.
+def compact_cache_file(ctx):
+    tmpfn = ctx.cache_filename + '.tmp'
+    outf = open(tmpfn, 'w', encoding='utf8', errors='surrogateescape',
+        newline='\n')
+    outf.write(g_cache_header+'\n')
+
+    for key in sorted(ctx.cache):
+        x = ctx.cache[key]
+        try:
+            st = stat_to_cache_stat(os.stat(key[1]))
+        except OSError:
+            continue
+        if st==x[0]:
+            outf.write(cache_entry_to_line(key, x))
+
+    outf.close()
+    os.replace(tmpfn, ctx.cache_filename)
+
+# Things to do with a result, in the main process, before it is reported.
+def finish_result(ctx, fctx):
+    if ctx.cachef is not None:
+        cache_add_result(ctx, fctx)
+
+    if ctx.stats is not None:
+        t0 = time.perf_counter()
+        idstr = dict_lookup(ctx, fctx.hash)
+        ctx.stats.add_time('lookup', time.perf_counter()-t0)
+    else:
+        idstr = dict_lookup(ctx, fctx.hash)
+    if idstr is not None:
+        fctx.file_id = idstr
+
+# Returns a line of output (including the newline) for a finished result.
+def format_result(ctx, fctx):
     if ctx.opt_uppercase:
-        print('%08X' % (fctx.hash), end='')
+        line = '%08X' % (fctx.hash)
     else:
-        print('%08x' % (fctx.hash), end='')
-    print(';csz=%d;fsz=%d;t=%s;m=%s;h=%s;id=%s|%s' % ( \
+        line = '%08x' % (fctx.hash)
+    line += ';csz=%d;fsz=%d;t=%s;m=%s;h=%s' % ( \
         fctx.hash_len, fctx.filesize, \
-        fctx.ffmt, fctx.msg, fctx.hash_strat, \
-        fctx.file_id, fctx.name_friendly))
+        fctx.ffmt, fctx.msg, fctx.hash_strat)
+    for name, val in fctx.digests:
+        if ctx.opt_uppercase:
+            val = val.upper()
+        line += ';%s=%s' % (name, val)
+    line += ';id=%s|%s\n' % (fctx.file_id, fctx.name_friendly)
+    return line
+
+def print_result(ctx, fctx):
+    finish_result(ctx, fctx)
+    sys.stdout.write(format_result(ctx, fctx))
+
+# Returns (force_wholefile, also_wholefile), based on the -a and -w
+# options.
+def get_wholefile_flags(ctx):
+    if ctx.opt_wholefile_only:
+        return True, False
+    return False, ctx.opt_wholefile_also
+
+# Returns a list of file_context objects: one for each line of output.
+def hash_one_input(ctx, fn):
+    force_wholefile, also_wholefile = get_wholefile_flags(ctx)
+
+    if ctx.opt_archives:
+        atype = get_input_archive_type(ctx, fn, force_wholefile)
+        if atype!='':
+            return onearchive(ctx, fn, atype, force_wholefile, also_wholefile)
+
+    return onefile(ctx, fn, force_wholefile, also_wholefile)
+
+# Yields filenames read from stdin, as soon as each one is available.
+def read_stdin_names(ctx):
+    inf = sys.stdin.buffer
+    if ctx.stdin_list_delim==b'\n':
+        for line in inf:
+            line = line.rstrip(b'\r\n')
+            if len(line)>0:
+                yield os.fsdecode(line)
+        return
+
+    pending = b''
+    while True:
+        data = inf.read1(65536)
+        if not data:
+            break
+        pending += data
+        items = pending.split(ctx.stdin_list_delim)
+        pending = items.pop()
+        for item in items:
+            if len(item)>0:
+                yield os.fsdecode(item)
+    if len(pending)>0:
+        yield os.fsdecode(pending)
+
+# With --shard, a file belongs to shard (CRC of its name, mod n), so that
+# the same file always goes to the same shard, no matter which other files
+# there are. The name is the one that would be printed.
+def is_in_shard(ctx, fn):
+    if (len(fn)>2) and (fn[0:2]=='./'):
+        fn = fn[2:]
+    return zlib.crc32(os.fsencode(fn)) % ctx.shard[1] == ctx.shard[0]-1
+
+# Yields the names of the files to process. With -r, directories are
+# walked in sorted order, so that the output order is stable.
+def expand_input_names(ctx, names):
+    if ctx.opt_stdin_list:
+        names = itertools.chain(names, read_stdin_names(ctx))
+
+    for fn in names:
+        if ctx.opt_recurse and os.path.isdir(fn):
+            for dirpath, dirnames, filenames in os.walk(fn):
+                dirnames.sort()
+                for x in sorted(filenames):
+                    fn2 = os.path.join(dirpath, x)
+                    if ctx.shard is None or is_in_shard(ctx, fn2):
+                        yield fn2
+        else:
+            if ctx.shard is None or is_in_shard(ctx, fn):
+                yield fn
+
+g_worker_ctx = None
+
+def worker_init(wctx):
+    global g_worker_ctx
+    g_worker_ctx = wctx
+
+def worker_hash_one_input(fn):
+    return hash_one_input(g_worker_ctx, fn)
+
+def worker_run(job):
+    func, fn = job
+    return func(g_worker_ctx, fn)
+
+# Like hash_one_input(), but for file contents that are in memory.
+def hash_one_blob(ctx, name, data):
+    force_wholefile, also_wholefile = get_wholefile_flags(ctx)
+    fctx = new_file_context(ctx, name)
+    fctx.inf = io.BytesIO(data)
+    fctx.isopen = True
+    fctx.filesize = len(data)
+    results = onestream(ctx, fctx, force_wholefile, also_wholefile)
+    fctx.inf = None
+    return results
+
+def worker_hash_one_blob(name, data):
+    return hash_one_blob(g_worker_ctx, name, data)
+
+# Returns a copy of ctx that is suitable for passing to worker processes.
+def make_worker_ctx(ctx):
+    # The workers don't need the dictionary; lookups are done in the main
+    # process.
+    wctx = copy.copy(ctx)
+    wctx.dicts = []
+    wctx.cachef = None
+    wctx.stats = None
+    return wctx
+
+# Yields func(ctx, name) for each name, using worker processes. func must
+# be a module-level function.
+def map_inputs_parallel(ctx, func, names, ordered):
+    wctx = make_worker_ctx(ctx)
+    jobs = ((func, fn) for fn in names)
+
+    with multiprocessing.Pool(ctx.num_jobs, worker_init, (wctx,)) as pool:
+        if ordered:
+            it = pool.imap(worker_run, jobs, 16)
+        else:
+            it = pool.imap_unordered(worker_run, jobs, 16)
+        for results in it:
+            yield results
+
+def map_inputs(ctx, func, names, ordered=True):
+    if ctx.stats is not None:
+        for results in map_inputs_nostats(ctx, func, names, ordered):
+            ctx.stats.add_results(results)
+            yield results
+        return
+
+    yield from map_inputs_nostats(ctx, func, names, ordered)
 
-    ctx.prev_hash_strat = fctx.hash_strat
+def map_inputs_nostats(ctx, func, names, ordered):
+    if ctx.num_jobs>1:
+        yield from map_inputs_parallel(ctx, func, names, ordered)
+        return
+
+    for fn in names:
+        yield func(ctx, fn)
+
+# A read-only file-like object, holding the parts of a file that were read
+# ahead of time. Only the prefetched ranges can be read.
+class prefetched_file:
+    def __init__(self):
+        self.ranges = [] # list of (pos, memoryview)
+        self.pos = 0
+
+    def seek(self, pos, whence=0):
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        for rpos, data in self.ranges:
+            if rpos <= self.pos < rpos+len(data):
+                n = min(len(b), rpos+len(data)-self.pos)
+                b[0:n] = data[self.pos-rpos : self.pos-rpos+n]
+                self.pos += n
+                return n
+        return 0
+
+    def close(self):
+        self.ranges = []
+
+# Returns the (pos, len) ranges that hash_stream() will read, sorted and
+# with overlaps merged.
+def get_ranges_to_read(fctx, also_wholefile):
+    if also_wholefile and fctx.hash_strat>1:
+        return [(0, fctx.filesize)]
+    ranges = []
+    for rpos, rlen in sorted(fctx.hash_regions):
+        if len(ranges)>0 and rpos <= ranges[-1][0]+ranges[-1][1]:
+            end = max(ranges[-1][0]+ranges[-1][1], rpos+rlen)
+            ranges[-1] = (ranges[-1][0], end-ranges[-1][0])
+        else:
+            ranges.append((rpos, rlen))
+    return ranges
+
+# Runs in an I/O thread: Do everything for one input except the hashing.
+# Returns (results, None) if there is nothing left to do, or (None, fctx)
+# where fctx.inf is a prefetched_file (or, if the file is too big to read
+# into memory, the real file).
+# Archives are not prefetched; they are returned as (None, fn).
+def prefetch_one_input(ctx, fn):
+    force_wholefile, also_wholefile = get_wholefile_flags(ctx)
+
+    if ctx.opt_archives and \
+        get_input_archive_type(ctx, fn, force_wholefile)!='':
+        return None, fn
+
+    results, fctx = onefile_start(ctx, fn, force_wholefile, also_wholefile)
+    if fctx is None:
+        return results, None
+    if fctx.hash_strat==0:
+        fctx.inf.close()
+        fctx.inf = None
+        return [fctx], None
+
+    ranges = get_ranges_to_read(fctx, also_wholefile)
+    if sum([x[1] for x in ranges]) > ctx.prefetch_max_bytes:
+        return None, fctx
+
+    if fctx.phase_times is not None:
+        t0 = time.perf_counter()
+    pf = prefetched_file()
+    for rpos, rlen in ranges:
+        fctx.inf.seek(rpos, 0)
+        pf.ranges.append((rpos, memoryview(fctx.inf.read(rlen))))
+    fctx.inf.close()
+    fctx.inf = pf
+    if fctx.phase_times is not None:
+        add_phase_time(fctx.phase_times, 'read', t0)
+    return None, fctx
+
+# Runs in the main thread: Finish what prefetch_one_input() started.
+def finish_prefetched_input(ctx, x):
+    results, y = x
+    if results is not None:
+        return results
+    if isinstance(y, str):
+        return hash_one_input(ctx, y)
+    force_wholefile, also_wholefile = get_wholefile_flags(ctx)
+    return onefile_finish(ctx, y, also_wholefile)
+
+# Like map_inputs(ctx, hash_one_input, ...), but opening, analyzing, and
+# reading the files is done ahead of time by a pool of I/O threads, so
+# that I/O latency overlaps with hashing. The number of files in flight is
+# limited, and results are returned in input order.
+def hash_inputs_prefetch(ctx, names):
+    window = collections.deque()
+    max_window = 4*ctx.prefetch_threads
+
+    with concurrent.futures.ThreadPoolExecutor(ctx.prefetch_threads) as ex:
+        try:
+            for fn in names:
+                window.append(ex.submit(prefetch_one_input, ctx, fn))
+                if len(window)>=max_window:
+                    yield finish_prefetched_input(ctx, \
+                        window.popleft().result())
+            while len(window)>0:
+                yield finish_prefetched_input(ctx, window.popleft().result())
+        finally:
+            # Don't leave any files open, if we stop early.
+            for fut in window:
+                fut.cancel()
+            for fut in window:
+                if not fut.cancelled() and fut.exception() is None:
+                    results, fctx = fut.result()
+                    if fctx is not None and not isinstance(fctx, str):
+                        fctx.inf.close()
+
+# Yields a list of unfinished results for each name.
+def hash_inputs(ctx, names):
+    if ctx.prefetch_threads>0 and ctx.num_jobs==1:
+        if ctx.stats is not None:
+            for results in hash_inputs_prefetch(ctx, names):
+                ctx.stats.add_results(results)
+                yield results
+            return
+        yield from hash_inputs_prefetch(ctx, names)
+        return
+
+    yield from map_inputs(ctx, hash_one_input, names, \
+        not ctx.opt_unordered)
+
+def process_files(ctx, names):
+    if ctx.opt_dups:
+        find_dups(ctx, names)
+        return
+    if ctx.sim_threshold is not None:
+        find_similar(ctx, names)
+        return
+
+    if ctx.num_jobs>1 and ctx.opt_unordered and ctx.sqlite_filename=='':
+        # Mark the output, so nobody mistakes it for a stable ordering.
+        # (Dictionary files ignore lines starting with '#'.)
+        print('# order=as-completed')
+
+    if ctx.sqlite_filename!='':
+        sink = sqlite_sink(ctx)
+        for results in hash_inputs(ctx, names):
+            for fctx in results:
+                finish_result(ctx, fctx)
+                sink.add(fctx)
+        sink.close()
+        return
+
+    for results in hash_inputs(ctx, names):
+        for fctx in results:
+            print_result(ctx, fctx)
+
+# For duplicate finding: Analyze one input, without hashing it if
+# possible. Archive members are always hashed.
+def prescan_one_input(ctx, fn):
+    force_wholefile = ctx.opt_wholefile_only
+    if ctx.opt_archives:
+        atype = get_input_archive_type(ctx, fn, force_wholefile)
+        if atype!='':
+            return onearchive(ctx, fn, atype, force_wholefile, False)
+
+    fctx = new_file_context(ctx, fn)
+    if ctx.cache is not None:
+        if cache_lookup(ctx, fctx, fn, force_wholefile):
+            return [fctx]
+
+    try:
+        fctx.inf = open(fn, "rb")
+        fctx.isopen = True
+    except OSError:
+        fctx.msg = "CANT-READ"
+        return [fctx]
+
+    fctx.inf.seek(0, 2)
+    fctx.filesize = fctx.inf.tell()
+    analyze_stream(ctx, fctx, force_wholefile)
+    fctx.inf.close()
+    fctx.inf = None
+    return [fctx]
+
+def hash_for_dups(ctx, fn):
+    return onefile(ctx, fn, ctx.opt_wholefile_only, False)
+
+# Find groups of files with the same hash and csz, and print the groups
+# that have more than one member, separated by blank lines.
+# Files are first grouped by csz, which is known without reading the
+# part of the file to be hashed. Files with a unique csz are not hashed.
+def find_dups(ctx, names):
+    records = []
+    for results in map_inputs(ctx, prescan_one_input, names):
+        for fctx in results:
+            if fctx.hash_strat>0:
+                records.append(fctx)
+
+    size_count = {}
+    for fctx in records:
+        size_count[fctx.hash_len] = size_count.get(fctx.hash_len, 0) + 1
+
+    to_hash = []
+    for i in range(len(records)):
+        if (not records[i].hashed) and (size_count[records[i].hash_len]>1):
+            to_hash.append(i)
+
+    # These files were already counted by the first pass, so only the work
+    # done here is added to the statistics.
+    hashed_results = map_inputs_nostats(ctx, hash_for_dups, \
+        [records[i].name_friendly for i in to_hash], True)
+    for i, results in zip(to_hash, hashed_results):
+        if ctx.stats is not None:
+            ctx.stats.add_work(results)
+        records[i] = results[0]
+
+    groups = {}
+    for fctx in records:
+        if fctx.hashed:
+            finish_result(ctx, fctx)
+            if fctx.hash_strat>0:
+                groups.setdefault((fctx.hash, fctx.hash_len), []).append(fctx)
+    print_groups(ctx, groups.values())
+
+def print_groups(ctx, groups):
+    first_group = True
+    for group in groups:
+        if len(group)<2:
+            continue
+        if not first_group:
+            sys.stdout.write('\n')
+        first_group = False
+        for fctx in group:
+            sys.stdout.write(format_result(ctx, fctx))
+
+# Group files into families of similar files, and print the families that
+# have more than one member, separated by blank lines. Two files are in
+# the same family if there is a chain of files between them, each at least
+# ctx.sim_threshold similar to the next.
+def find_similar(ctx, names):
+    records = []
+    sigs = []
+    for results in hash_inputs(ctx, names):
+        for fctx in results:
+            finish_result(ctx, fctx)
+            if fctx.is_extra_wholefile or fctx.hash_strat==0:
+                continue
+            records.append(fctx)
+            sigs.append(parse_sim_digest(dict(fctx.digests)['sim']))
+
+    index = sim_index(ctx.sim_threshold)
+    for i in range(len(sigs)):
+        index.add(i, sigs[i])
+
+    # Union-find
+    parent = list(range(len(records)))
+    def find_root(i):
+        while parent[i]!=i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i in range(len(sigs)):
+        for j, sim in index.query(sigs[i]):
+            ri = find_root(i)
+            rj = find_root(j)
+            if ri!=rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    groups = {}
+    for i in range(len(records)):
+        groups.setdefault(find_root(i), []).append(records[i])
+    print_groups(ctx, groups.values())
+
+# Adds the time since t0 to the given phase, and returns the current time.
+def add_phase_time(phase_times, phase, t0):
+    t1 = time.perf_counter()
+    phase_times[phase] = phase_times.get(phase, 0.0) + (t1-t0)
+    return t1
+
+g_stats_phases = ['open', 'header', 'read', 'hash', 'lookup']
+
+def format_size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n<1024:
+            return '%d%s' % (n, unit)
+        n //= 1024
+    return '%dTiB' % (n)
+
+# Statistics for --stats, collected in the main process. The per-file phase
+# times are measured wherever the file is processed (possibly in a worker
+# process), and added up here. With -j, the phase times are totals over
+# all workers, so they can add up to more than the elapsed time.
+class run_stats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phase_times = {}
+        self.num_files = 0
+        self.num_cached = 0
+        self.bytes_read = 0
+        self.size_hist = {} # hash_strat -> {size bucket: count}
+
+    def add_time(self, phase, t):
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + t
+
+    # Add the bytes read and phase times, without counting the files again.
+    def add_work(self, results):
+        for fctx in results:
+            if fctx.is_extra_wholefile:
+                continue
+            self.bytes_read += fctx.bytes_read
+            if fctx.phase_times is not None:
+                for phase, t in fctx.phase_times.items():
+                    self.add_time(phase, t)
+
+    def add_results(self, results):
+        for fctx in results:
+            if fctx.is_extra_wholefile:
+                # Already counted, with the main result.
+                continue
+            self.num_files += 1
+            if fctx.from_cache:
+                self.num_cached += 1
+            self.bytes_read += fctx.bytes_read
+            if fctx.phase_times is not None:
+                for phase, t in fctx.phase_times.items():
+                    self.add_time(phase, t)
+            # Bucket n holds sizes less than 2**n, and at least 2**(n-1).
+            hist = self.size_hist.setdefault(fctx.hash_strat, {})
+            bucket = fctx.filesize.bit_length()
+            hist[bucket] = hist.get(bucket, 0) + 1
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.start_time
+        d = {'elapsed_sec': elapsed, 'files': self.num_files,
+            'cached_files': self.num_cached, 'bytes_read': self.bytes_read}
+        if elapsed>0:
+            d['files_per_sec'] = self.num_files / elapsed
+            d['mb_per_sec'] = self.bytes_read / 1000000 / elapsed
+        d['phase_sec'] = {}
+        for phase in g_stats_phases:
+            d['phase_sec'][phase] = self.phase_times.get(phase, 0.0)
+        d['size_histogram'] = {}
+        for strat in sorted(self.size_hist):
+            hist = self.size_hist[strat]
+            d['size_histogram'][str(strat)] = \
+                [{'max_size': (1 << bucket) - 1, 'files': hist[bucket]} \
+                for bucket in sorted(hist)]
+        return d
+
+    def write_text(self, outf):
+        d = self.as_dict()
+        outf.write('files: %d (%d from cache)\n' % (d['files'], \
+            d['cached_files']))
+        outf.write('bytes read: %d\n' % (d['bytes_read']))
+        outf.write('elapsed: %.3f s\n' % (d['elapsed_sec']))
+        if 'files_per_sec' in d:
+            outf.write('throughput: %.1f files/s, %.2f MB/s\n' % \
+                (d['files_per_sec'], d['mb_per_sec']))
+        for phase in g_stats_phases:
+            outf.write('  %-7s %10.3f s\n' % (phase, d['phase_sec'][phase]))
+        for strat in sorted(self.size_hist):
+            outf.write('file sizes, h=%d:\n' % (strat))
+            hist = self.size_hist[strat]
+            for bucket in sorted(hist):
+                outf.write('  <%-7s %8d\n' % (format_size(1 << bucket), \
+                    hist[bucket]))
+
+def write_stats(ctx):
+    if ctx.stats_filename=='':
+        ctx.stats.write_text(sys.stderr)
+        return
+    with open(ctx.stats_filename, 'w', encoding='utf8') as outf:
+        json.dump(ctx.stats.as_dict(), outf, indent=1)
+        outf.write('\n')
+
+def digests_to_str(ctx, digests):
+    return ';'.join(['%s=%s' % (name, val) for name, val in digests])
+
+# Writes results to an SQLite database, instead of printing them.
+# There is one row per file. With -a, the whole-file hash goes in the same
+# row as the main hash. Rows are replaced if the same path is seen again.
+class sqlite_sink:
+    batch_size = 1000
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.db = sqlite3.connect(ctx.sqlite_filename)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                hash INTEGER,
+                csz INTEGER,
+                fsz INTEGER,
+                fmt TEXT,
+                msg TEXT,
+                strat INTEGER,
+                file_id TEXT,
+                digests TEXT,
+                whole_hash INTEGER,
+                whole_digests TEXT);
+            CREATE INDEX IF NOT EXISTS files_hash ON files(hash, csz);
+            CREATE INDEX IF NOT EXISTS files_whole_hash ON files(whole_hash);
+            CREATE INDEX IF NOT EXISTS files_fsz ON files(fsz);
+            CREATE INDEX IF NOT EXISTS files_fmt ON files(fmt);
+            ''')
+        self.rows = []
+        self.pending = None
+
+    def add(self, fctx):
+        if fctx.is_extra_wholefile and (self.pending is not None):
+            self.pending[9] = fctx.hash
+            self.pending[10] = digests_to_str(self.ctx, fctx.digests)
+            return
+
+        self.flush_pending()
+        self.pending = [fctx.name_friendly, fctx.hash, fctx.hash_len,
+            fctx.filesize, fctx.ffmt, fctx.msg, fctx.hash_strat,
+            fctx.file_id, digests_to_str(self.ctx, fctx.digests), None, None]
+        if fctx.hash_strat==1:
+            self.pending[9] = fctx.hash
+            self.pending[10] = self.pending[8]
+
+    def flush_pending(self):
+        if self.pending is None:
+            return
+        self.rows.append(self.pending)
+        self.pending = None
+        if len(self.rows) >= self.batch_size:
+            self.write_rows()
+
+    def write_rows(self):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES ' \
+                '(?,?,?,?,?,?,?,?,?,?,?)', self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush_pending()
+        self.write_rows()
+        self.db.close()
+
+# Server mode protocol (over a Unix domain socket):
+# Each request is a line, terminated by a newline:
+#   "P <path>" - Hash the file at <path>.
+#   "D <size> <name>" - Hash the <size> bytes that follow the newline. Use
+#      <name> as the name.
+# The response is zero or more lines in the usual output format, followed
+# by an empty line. Lines starting with "#" report errors.
+class server_request_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        srv = self.server
+        while True:
+            line1 = self.rfile.readline()
+            if not line1:
+                break
+            line = line1.rstrip(b'\r\n').decode('utf8', \
+                errors='surrogateescape')
+
+            results = None
+            errmsg = ''
+            if line[0:2]=='P ':
+                results = server_run(srv, worker_hash_one_input, line[2:])
+            elif line[0:2]=='D ':
+                ss = line[2:].split(' ', maxsplit=1)
+                if len(ss)<2 or not ss[0].isdigit():
+                    errmsg = 'bad request'
+                else:
+                    data = self.rfile.read(int(ss[0]))
+                    if len(data)<int(ss[0]):
+                        break
+                    results = server_run(srv, worker_hash_one_blob, \
+                        ss[1], data)
+            else:
+                errmsg = 'bad request'
+
+            resp = ''
+            if results is not None:
+                with srv.lock:
+                    for fctx in results:
+                        finish_result(srv.ctx, fctx)
+                        resp += format_result(srv.ctx, fctx)
+                    if srv.ctx.cachef is not None:
+                        srv.ctx.cachef.flush()
+            if errmsg!='':
+                resp += '# error: %s\n' % (errmsg)
+            resp += '\n'
+            self.wfile.write(resp.encode('utf8', errors='surrogateescape'))
+
+def server_worker_init(wctx):
+    # Let the main process handle Ctrl+C and SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    worker_init(wctx)
+
+def server_worker_noop():
+    pass
+
+# Run a worker function, in a worker process if we have them.
+def server_run(srv, func, *args):
+    if srv.pool is not None:
+        return srv.pool.submit(func, *args).result()
+    with srv.lock:
+        return func(*args)
+
+def server_sigterm_handler(signum, frame):
+    raise KeyboardInterrupt
+
+def run_server(ctx):
+    sockname = ctx.server_socket_name
+    try:
+        if stat.S_ISSOCK(os.stat(sockname).st_mode):
+            os.unlink(sockname) # Left over from a previous run
+    except FileNotFoundError:
+        pass
+
+    wctx = make_worker_ctx(ctx)
+    srv = socketserver.ThreadingUnixStreamServer(sockname, \
+        server_request_handler)
+    srv.daemon_threads = True
+    srv.ctx = ctx
+    srv.lock = threading.Lock()
+    if ctx.num_jobs>1:
+        srv.pool = concurrent.futures.ProcessPoolExecutor(ctx.num_jobs, \
+            initializer=server_worker_init, initargs=(wctx,))
+        # Start the worker processes now, while this is the only thread.
+        # Otherwise they would be forked on the first request, from a
+        # handler thread, while other threads might be holding locks.
+        futures = [srv.pool.submit(server_worker_noop) \
+            for i in range(ctx.num_jobs)]
+        for f in futures:
+            f.result()
+    else:
+        srv.pool = None
+        worker_init(wctx)
+
+    # Shut down cleanly on SIGTERM, as well as on Ctrl+C.
+    signal.signal(signal.SIGTERM, server_sigterm_handler)
+
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        os.unlink(sockname)
+        if srv.pool is not None:
+            srv.pool.shutdown()
+
+# Library interface: Fingerprint one file. src can be a filename, a binary
+# file object (which must be seekable), or a bytes-like object.
+# Returns a file_context object. Use its as_dict() method, or its
+# attributes (hash, hash_len, filesize, ffmt, msg, hash_strat, file_id,
+# digests, name_friendly).
+# Options are taken from ctx (see the context class), except that -a and
+# -w are replaced by the wholefile parameter.
+def fingerprint(src, ctx=None, name=None, wholefile=False):
+    if ctx is None:
+        ctx = context()
+
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        inf = io.BytesIO(src)
+        if name is None:
+            name = '<bytes>'
+    elif hasattr(src, 'read'):
+        inf = src
+        if name is None:
+            name = str(getattr(src, 'name', '<file>'))
+    else:
+        fn = os.fspath(src)
+        if name is None:
+            name = fn
+        fctx = onefile(ctx, fn, wholefile, False)[0]
+        fctx.name_friendly = name
+        finish_result(ctx, fctx)
+        return fctx
+
+    fctx = new_file_context(ctx, name)
+    fctx.inf = inf
+    fctx.isopen = True
+    inf.seek(0, 2)
+    fctx.filesize = inf.tell()
+    onestream(ctx, fctx, wholefile, False)
+    fctx.inf = None
+    finish_result(ctx, fctx)
+    return fctx
+
+# Library interface: Fingerprint many files. Yields a file_context object
+# for each result, like the lines printed by the command-line utility.
+# Honors all the options in ctx, including num_jobs (worker processes),
+# opt_wholefile_*, opt_recurse, and opt_archives.
+def hash_many(names, ctx=None):
+    if ctx is None:
+        ctx = context()
+
+    for results in hash_inputs(ctx, expand_input_names(ctx, names)):
+        for fctx in results:
+            finish_result(ctx, fctx)
+            yield fctx
 
 def read_dict_file(ctx, dict_fn):
+    if is_compiled_dict_file(dict_fn):
+        ctx.dicts.append(compiled_dict(dict_fn))
+        return
+
+    # Consecutive text dictionaries are merged into one Python dict.
+    if len(ctx.dicts)>0 and isinstance(ctx.dicts[-1], dict):
+        d = ctx.dicts[-1]
+    else:
+        d = {}
+        ctx.dicts.append(d)
+
     dict_inf = open(dict_fn, 'r', encoding='utf8', errors='replace')
 
     linenum = 0
@@ -226,28 +1715,181 @@ def read_dict_file(ctx, dict_fn):
         line = line1.rstrip('\r\n')
         if (len(line)==0) or (line[0:1]=='#'):
             continue
-        ss = line.split(sep='|')
-        if len(ss)<2:
-            raise Exception(f"Bad dictionary (line {linenum})")
-        linenum += 1
-        idstr = ss[-1] # Want everything after the last '|'
-        crcstr = line[0:8]
-        crcnum = int(crcstr, base=16)
-
-        if (crcnum!=0) and not (crcnum in ctx.dict):
-            ctx.dict[crcnum] = idstr
+        crcnum, idstr = parse_dict_line(line, linenum)
+        if (crcnum!=0) and not (crcnum in d):
+            d[crcnum] = idstr
 
     dict_inf.close()
 
+# Returns (crc, identifier) for a line of a text dictionary.
+def parse_dict_line(line, linenum):
+    ss = line.split(sep='|')
+    if len(ss)<2:
+        raise Exception(f"Bad dictionary (line {linenum})")
+    idstr = ss[-1] # Want everything after the last '|'
+    crcstr = line[0:8]
+    crcnum = int(crcstr, base=16)
+    return crcnum, idstr
+
+# Compiled dictionary format:
+#  16-byte header: signature, number of entries (uint32le), reserved
+#  Index: For each entry, sorted by CRC: CRC (uint32le),
+#    offset of the identifier from the start of the string area (uint32le)
+#  String area: UTF-8 identifiers, each terminated by a newline
+g_cdict_sig = b'EXHDICT1'
+
+def is_compiled_dict_file(dict_fn):
+    inf = open(dict_fn, 'rb')
+    sig = inf.read(8)
+    inf.close()
+    return sig==g_cdict_sig
+
+# A compiled dictionary file, memory-mapped, and searched with a binary
+# search.
+class compiled_dict:
+    def __init__(self, dict_fn):
+        inf = open(dict_fn, 'rb')
+        self.mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        inf.close()
+        if len(self.mm)<16 or self.mm[0:8]!=g_cdict_sig:
+            raise Exception("Bad compiled dictionary")
+        self.count = (struct.unpack_from("<L", self.mm, 8))[0]
+        self.strings_pos = 16 + 8*self.count
+        if self.strings_pos > len(self.mm):
+            raise Exception("Bad compiled dictionary")
+    def get_id_at(self, idx):
+        offs = (struct.unpack_from("<L", self.mm, 16+8*idx+4))[0]
+        pos1 = self.strings_pos + offs
+        pos2 = self.mm.find(b'\n', pos1)
+        return self.mm[pos1:pos2].decode('utf8', errors='replace')
+    def get(self, crc):
+        lo = 0
+        hi = self.count
+        while lo<hi:
+            mid = (lo+hi)//2
+            x = (struct.unpack_from("<L", self.mm, 16+8*mid))[0]
+            if x<crc:
+                lo = mid+1
+            elif x>crc:
+                hi = mid
+            else:
+                return self.get_id_at(mid)
+        return None
+    def items(self):
+        for idx in range(self.count):
+            crc = (struct.unpack_from("<L", self.mm, 16+8*idx))[0]
+            yield crc, self.get_id_at(idx)
+
+def dict_lookup(ctx, crc):
+    for d in ctx.dicts:
+        idstr = d.get(crc)
+        if idstr is not None:
+            return idstr
+    return None
+
+# Merge all the dictionaries (first one wins), and write a compiled
+# dictionary file.
+def write_compiled_dict(ctx):
+    merged = {}
+    for d in ctx.dicts:
+        for crc, idstr in d.items():
+            if not (crc in merged):
+                merged[crc] = idstr
+
+    index = bytearray()
+    strings = bytearray()
+    for crc in sorted(merged):
+        index += struct.pack("<LL", crc, len(strings))
+        strings += merged[crc].encode('utf8') + b'\n'
+
+    outf = open(ctx.compile_dict_filename, 'wb')
+    outf.write(g_cdict_sig)
+    outf.write(struct.pack("<LL", len(merged), 0))
+    outf.write(index)
+    outf.write(strings)
+    outf.close()
+
+# Combine the outputs of several runs (e.g. one per shard) into one file,
+# sorted by filename, with duplicate lines removed. Optionally, also write a
+# text dictionary with one line per hash. The -d dictionaries take priority,
+# followed by the merged results in sorted order, with the usual first-wins
+# rule. So the dictionary doesn't depend on how the files were sharded.
+def merge_results(ctx, names):
+    lines = {} # Used as an ordered set
+    for fn in names:
+        inf = open(fn, 'r', encoding='utf8', errors='surrogateescape')
+        linenum = 0
+        for line1 in inf:
+            linenum += 1
+            line = line1.rstrip('\r\n')
+            if (len(line)==0) or (line[0:1]=='#'):
+                continue
+            if not ('|' in line):
+                raise Exception(f"Bad result line ({fn}, line {linenum})")
+            lines[line] = None
+        inf.close()
+
+    # Sort by the filename: everything after the first '|'. The sort is
+    # stable, so lines for the same file (e.g. from -a) stay in order.
+    sorted_lines = sorted(lines, key=lambda x: x.split('|', 1)[1])
+
+    outf = open(ctx.merge_filename, 'w', encoding='utf8',
+        errors='surrogateescape', newline='\n')
+    for line in sorted_lines:
+        outf.write(line + '\n')
+    outf.close()
+
+    if ctx.merge_dict_filename=='':
+        return
+
+    merged = {}
+    for d in ctx.dicts:
+        for crc, idstr in d.items():
+            if not (crc in merged):
+                merged[crc] = idstr
+    for linenum, line in enumerate(sorted_lines, 1):
+        crc, idstr = parse_dict_line(line, linenum)
+        if (crc!=0) and not (crc in merged):
+            merged[crc] = idstr
+
+    outf = open(ctx.merge_dict_filename, 'w', encoding='utf8',
+        errors='surrogateescape', newline='\n')
+    for crc in sorted(merged):
+        outf.write('%08x|%s\n' % (crc, merged[crc]))
+    outf.close()
+
 def usage():
     print("Exehash")
     print("Checksum the \"code image\" segment of an EXE file")
     print("Usage: exehash.py [options] file1 [file2...]")
     print("  Options:")
-    print("   -d <dictfile> : Use a dictionary file")
+    print("   -d <dictfile> : Use a dictionary file (text or compiled)")
+    print("   --compile-dict <outfile> : Compile the -d dictionaries, and exit")
     print("   -u : Print uppercase hex digits")
     print("   -a : Also compute hash on whole file")
     print("   -w : Only compute hash on whole file")
+    print("   -r : Recurse into directories")
+    print("   -i : Read filenames from stdin, one per line")
+    print("   -0 : Read filenames from stdin, separated by NUL characters")
+    print("   -z : Hash the files inside ZIP and TAR archives")
+    print("   -s : For NE and PE files, hash only the code sections")
+    print("   -g <alg1,alg2,...> : Also compute these digests (e.g. sha256,md5)")
+    print("   -j <n> : Use n worker processes (0 = one per CPU)")
+    print("   --unordered : With -j, print results as they complete")
+    print("   --prefetch <n> : Read files ahead, with n I/O threads")
+    print("   --server <socket> : Run as a server on a Unix domain socket")
+    print("   --sqlite <dbfile> : Write results to an SQLite database")
+    print("   --dups : Print only groups of duplicate files")
+    print("   --similar <pct> : Print only families of files that are at least")
+    print("       pct percent similar (implies -g sim)")
+    print("   --shard <i/n> : Process only the files in shard i (1 to n) of n")
+    print("   --merge <outfile> : Merge result files (e.g. from each shard)")
+    print("   --merge-dict <outfile> : With --merge, also write a dictionary")
+    print("   -c <cachefile> : Use a cache file, to skip unchanged files")
+    print("   --stats : Print timing statistics to stderr, at the end")
+    print("   --stats-json <file> : Write timing statistics to a JSON file")
+    print("   --cache-refresh : Ignore and rewrite the existing cache")
+    print("   --cache-compact : Remove stale entries from the cache")
 
 def main():
     ctx = context()
@@ -263,9 +1905,86 @@ def main():
                 ctx.opt_wholefile_also = True
             elif sys.argv[i][1:]=='w':
                 ctx.opt_wholefile_only = True
+            elif sys.argv[i][1:]=='r':
+                ctx.opt_recurse = True
+            elif sys.argv[i][1:]=='i':
+                ctx.opt_stdin_list = True
+            elif sys.argv[i][1:]=='0':
+                ctx.opt_stdin_list = True
+                ctx.stdin_list_delim = b'\0'
+            elif sys.argv[i][1:]=='z':
+                ctx.opt_archives = True
+            elif sys.argv[i][1:]=='s':
+                ctx.opt_sections = True
+            elif sys.argv[i][1:]=='g':
+                i += 1
+                for name in sys.argv[i].lower().split(','):
+                    if not (name in hashlib.algorithms_available or \
+                        name=='sim'):
+                        print('Unsupported digest "%s"' % (name))
+                        return
+                    # Variable-length digests (shake_*) are not supported.
+                    if name!='sim' and hashlib.new(name).digest_size==0:
+                        print('Unsupported digest "%s"' % (name))
+                        return
+                    if not (name in ctx.digest_names):
+                        ctx.digest_names.append(name)
             elif sys.argv[i][1:]=='d':
                 i += 1
                 dict_filenames.append(sys.argv[i])
+            elif sys.argv[i]=='--compile-dict':
+                i += 1
+                ctx.compile_dict_filename = sys.argv[i]
+            elif sys.argv[i][1:]=='j':
+                i += 1
+                ctx.num_jobs = int(sys.argv[i])
+                if ctx.num_jobs<1:
+                    ctx.num_jobs = os.cpu_count() or 1
+            elif sys.argv[i]=='--prefetch':
+                i += 1
+                ctx.prefetch_threads = int(sys.argv[i])
+            elif sys.argv[i]=='--unordered':
+                ctx.opt_unordered = True
+            elif sys.argv[i]=='--dups':
+                ctx.opt_dups = True
+            elif sys.argv[i]=='--similar':
+                i += 1
+                ctx.sim_threshold = float(sys.argv[i])/100.0
+                if not ('sim' in ctx.digest_names):
+                    ctx.digest_names.append('sim')
+            elif sys.argv[i]=='--sqlite':
+                i += 1
+                ctx.sqlite_filename = sys.argv[i]
+            elif sys.argv[i]=='--server':
+                i += 1
+                ctx.server_socket_name = sys.argv[i]
+            elif sys.argv[i][1:]=='c':
+                i += 1
+                ctx.cache_filename = sys.argv[i]
+            elif sys.argv[i]=='--cache-refresh':
+                ctx.opt_cache_refresh = True
+            elif sys.argv[i]=='--cache-compact':
+                ctx.opt_cache_compact = True
+            elif sys.argv[i]=='--shard':
+                i += 1
+                ss = sys.argv[i].split('/')
+                if len(ss)!=2 or not (ss[0].isdigit() and ss[1].isdigit()) \
+                    or not (1 <= int(ss[0]) <= int(ss[1])):
+                    print('Bad --shard "%s"; expected i/n' % (sys.argv[i]))
+                    return
+                ctx.shard = (int(ss[0]), int(ss[1]))
+            elif sys.argv[i]=='--merge':
+                i += 1
+                ctx.merge_filename = sys.argv[i]
+            elif sys.argv[i]=='--merge-dict':
+                i += 1
+                ctx.merge_dict_filename = sys.argv[i]
+            elif sys.argv[i]=='--stats':
+                ctx.opt_stats = True
+            elif sys.argv[i]=='--stats-json':
+                i += 1
+                ctx.opt_stats = True
+                ctx.stats_filename = sys.argv[i]
             else:
                 print('Unrecognized option "%s"' % (sys.argv[i]))
                 return
@@ -273,27 +1992,51 @@ def main():
             input_filenames.append(sys.argv[i])
         i += 1
 
-    if len(input_filenames)==0:
+    if ctx.opt_cache_compact and ctx.cache_filename=='':
+        print('--cache-compact requires -c')
+        return
+
+    if ctx.merge_dict_filename!='' and ctx.merge_filename=='':
+        print('--merge-dict requires --merge')
+        return
+
+    if len(input_filenames)==0 and not ctx.opt_cache_compact and \
+        ctx.compile_dict_filename=='' and ctx.server_socket_name=='' and \
+        not ctx.opt_stdin_list:
         usage()
         return
 
     if ctx.opt_wholefile_only and ctx.opt_wholefile_also:
         ctx.opt_wholefile_only = False
 
-    ctx.crcobj = crc32_class(crc32_factory())
-
     for fn in dict_filenames:
         read_dict_file(ctx, fn)
 
-    for fn in input_filenames:
-        if ctx.opt_wholefile_only:
-            onefile(ctx, fn, True)
-        else:
-            onefile(ctx, fn, False)
+    if ctx.compile_dict_filename!='':
+        write_compiled_dict(ctx)
+        return
+
+    if ctx.merge_filename!='':
+        merge_results(ctx, input_filenames)
+        return
+
+    if ctx.cache_filename!='':
+        read_cache_file(ctx)
+        open_cache_for_append(ctx)
+
+    if ctx.server_socket_name!='':
+        run_server(ctx)
+    else:
+        if ctx.opt_stats:
+            ctx.stats = run_stats()
+        process_files(ctx, expand_input_names(ctx, input_filenames))
+        if ctx.stats is not None:
+            write_stats(ctx)
 
-            # This is a hack, but it's an easy way to process the same
-            # file twice.
-            if ctx.opt_wholefile_also and (ctx.prev_hash_strat>1):
-                onefile(ctx, fn, True)
+    if ctx.cache is not None:
+        ctx.cachef.close()
+        if ctx.opt_cache_compact:
+            compact_cache_file(ctx)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# exehash_bench: Benchmarks for Exehash, using a synthetic corpus.
+# Copyright (C) 2025 Jason Summers
+# Terms of use: MIT license. See COPYING.txt.
+
+# The corpus is generated from a seed, so that it is the same every time.
+# Results can be saved as a baseline, and later runs compared to it.
+
+import sys
+import os
+import struct
+import random
+import json
+import time
+import subprocess
+import tempfile
+
+import exehash
+
+g_manifest_name = 'corpus.json'
+g_corpus_version = 2
+
+# Extended EXE formats, and their signatures
+g_ext_sigs = {'ne': b'NE', 'pe': b'PE\0\0', 'le': b'LE', 'lx': b'LX'}
+
+class context:
+    def __init__(ctx):
+        ctx.corpus_dir = ''
+        ctx.opt_generate = False
+        ctx.max_size = 1024*1024
+        ctx.seed = 1
+        ctx.repeat = 3
+        ctx.tolerance = 0.10
+        ctx.baseline_filename = ''
+        ctx.save_baseline_filename = ''
+        ctx.exehash_path = os.path.join(os.path.dirname( \
+            os.path.abspath(__file__)), 'exehash.py')
+        ctx.metrics = {}
+
+# Parses a size like "4096", "64K", "16M", or "1G".
+def parse_size(s):
+    mult = 1
+    if s[-1:].upper()=='K':
+        mult = 1024
+    elif s[-1:].upper()=='M':
+        mult = 1024*1024
+    elif s[-1:].upper()=='G':
+        mult = 1024*1024*1024
+    if mult>1:
+        s = s[:-1]
+    return int(s)*mult
+
+# The file sizes in the corpus: 1KB, then every factor of 16, up to
+# ctx.max_size.
+def get_corpus_sizes(ctx):
+    sizes = []
+    n = 1024
+    while n<=ctx.max_size:
+        sizes.append(n)
+        n *= 16
+    return sizes
+
+# Returns a list of (kind, variant) to generate for files of the given size.
+# Big files are only generated for a few kinds, to keep the corpus from
+# getting too large.
+def get_corpus_kinds(size):
+    if size>1024*1024:
+        return [('dos', 32), ('pe', 0), ('blob', 0)]
+    kinds = []
+    for cparhdr in (2, 4, 32, 512):
+        if 16*cparhdr < size:
+            kinds.append(('dos', cparhdr))
+    kinds.append(('trunc', 0))
+    for kind in g_ext_sigs:
+        kinds.append((kind, 0))
+    kinds.append(('blob', 0))
+    return kinds
+
+# Writes size random bytes, in chunks.
+def write_random(outf, rng, size):
+    while size>0:
+        n = min(size, 1024*1024)
+        outf.write(rng.randbytes(n))
+        size -= n
+
+# A DOS EXE header, padded to 16*cparhdr bytes. The file is size bytes
+# long, and the header says it is size+extra_bytes long.
+def make_dos_header(rng, size, cparhdr, extra_bytes):
+    hdrsize = 16*cparhdr
+    num_relocs = min((hdrsize-28)//4, rng.randrange(0, 64))
+    num_relocs = max(num_relocs, 0)
+    codeend = size+extra_bytes
+    hdr = bytearray(hdrsize)
+    struct.pack_into("<HHHHHHHHHHHHHH", hdr, 0, 0x5a4d, codeend%512,
+        (codeend+511)//512, num_relocs, cparhdr, 0x10, 0xffff, 0, 0x100,
+        0, 0, 0, 28, 0)
+    for i in range(num_relocs):
+        struct.pack_into("<HH", hdr, 28+4*i, rng.randrange(0, 65536),
+            rng.randrange(0, 16))
+    return hdr
+
+# An extended EXE: a DOS stub, then the new header signature at 0x80,
+# then random data. NE and PE files also get a segment or section table,
+# with at least one code segment or section, so that -s has something to
+# hash. Otherwise, the contents after the signature are not meant to be
+# valid.
+def make_ext_header(rng, size, sig):
+    hdr = make_dos_header(rng, 0x80, 4, 0)
+    struct.pack_into("<H", hdr, 6, 0)
+    struct.pack_into("<H", hdr, 24, 0x40)
+    struct.pack_into("<L", hdr, 60, 0x80)
+    hdr += bytes(0x80-len(hdr))
+    hdr += sig
+    if sig==g_ext_sigs['ne']:
+        hdr = make_ne_tables(rng, size, hdr)
+    elif sig==g_ext_sigs['pe']:
+        hdr = make_pe_tables(rng, size, hdr)
+    return hdr
+
+# Splits the part of the file from pos to size into up to max_count
+# chunks of up to max_len bytes, each starting at a multiple of align.
+# Returns a list of (pos, len).
+def split_file(rng, size, pos, max_count, max_len, align):
+    chunks = []
+    while pos<size and len(chunks)<max_count:
+        n = min(size-pos, rng.randrange(1, max_len+1))
+        chunks.append((pos, n))
+        pos = (pos+n+align-1)//align*align
+    return chunks
+
+# The NE header, and a segment table (at 0xc0) with up to 8 segments,
+# starting at 0x200. The first segment is code.
+def make_ne_tables(rng, size, hdr):
+    hdr += bytes(0x200-len(hdr))
+    segs = split_file(rng, size, 0x200, 8, 0x8000, 512)
+    struct.pack_into("<H", hdr, 0x80+0x1c, len(segs))
+    struct.pack_into("<H", hdr, 0x80+0x22, 0x40)
+    struct.pack_into("<H", hdr, 0x80+0x32, 9)
+    for i, (pos, n) in enumerate(segs):
+        flags = 0x0001 if (i>0 and rng.randrange(0, 2)) else 0x0000
+        struct.pack_into("<HHHH", hdr, 0xc0+8*i, pos>>9, n, flags, n)
+    return hdr
+
+# The PE (COFF) header, an empty optional header, and a section table
+# with up to 8 sections, starting at 0x300. The first section is code.
+def make_pe_tables(rng, size, hdr):
+    hdr += bytes(0x300-len(hdr))
+    sects = split_file(rng, size, 0x300, 8, 0x40000, 512)
+    struct.pack_into("<HHLLLHH", hdr, 0x84, 0x14c, len(sects), 0, 0, 0,
+        0xe0, 0x102)
+    for i, (pos, n) in enumerate(sects):
+        if i==0 or rng.randrange(0, 2):
+            name, flags = b'.text', 0x60000020
+        else:
+            name, flags = b'.data', 0xc0000040
+        o = 0x80+24+0xe0+40*i
+        hdr[o:o+len(name)] = name
+        struct.pack_into("<LLLL", hdr, o+8, n, 0x1000*(i+1), n, pos)
+        struct.pack_into("<L", hdr, o+36, flags)
+    return hdr
+
+def generate_one_file(ctx, fn, kind, variant, size):
+    rng = random.Random('%d/%s/%d/%d' % (ctx.seed, kind, variant, size))
+    if kind=='dos':
+        hdr = make_dos_header(rng, size, variant, 0)
+    elif kind=='trunc':
+        hdr = make_dos_header(rng, size, 32, rng.randrange(1, 100000))
+    elif kind=='blob':
+        hdr = b'\0'
+    else:
+        hdr = make_ext_header(rng, size, g_ext_sigs[kind])
+
+    with open(fn, 'wb') as outf:
+        outf.write(hdr)
+        write_random(outf, rng, size-len(hdr))
+
+# Generates the corpus, unless it already exists with the same parameters.
+def generate_corpus(ctx):
+    params = {'version': g_corpus_version, 'seed': ctx.seed,
+        'max_size': ctx.max_size}
+    manifest_fn = os.path.join(ctx.corpus_dir, g_manifest_name)
+    try:
+        with open(manifest_fn, 'r', encoding='utf8') as inf:
+            if json.load(inf)['params']==params:
+                return
+    except (OSError, ValueError, KeyError):
+        pass
+
+    os.makedirs(ctx.corpus_dir, exist_ok=True)
+    files = []
+    for size in get_corpus_sizes(ctx):
+        for kind, variant in get_corpus_kinds(size):
+            name = '%s%d-%d.exe' % (kind, variant, size)
+            print('Generating %s' % (name))
+            generate_one_file(ctx, os.path.join(ctx.corpus_dir, name), \
+                kind, variant, size)
+            files.append(name)
+
+    with open(manifest_fn, 'w', encoding='utf8') as outf:
+        json.dump({'params': params, 'files': files}, outf, indent=1)
+        outf.write('\n')
+
+# Returns the list of corpus files, from the manifest.
+def read_corpus_files(ctx):
+    manifest_fn = os.path.join(ctx.corpus_dir, g_manifest_name)
+    with open(manifest_fn, 'r', encoding='utf8') as inf:
+        manifest = json.load(inf)
+    return [os.path.join(ctx.corpus_dir, x) for x in manifest['files']]
+
+def add_metric(ctx, name, value, unit):
+    ctx.metrics[name] = {'value': value, 'unit': unit}
+
+# Run exehash.py on the whole corpus, with the given options. Reports the
+# best time of ctx.repeat runs, and the phase times from that run.
+def bench_end_to_end(ctx, label, options, files):
+    total_bytes = sum([os.path.getsize(fn) for fn in files])
+    best = None
+    for i in range(ctx.repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats_fn = os.path.join(tmpdir, 'stats.json')
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, ctx.exehash_path] + options + \
+                ['--stats-json', stats_fn] + files, check=True, \
+                stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - t0
+            with open(stats_fn, 'r', encoding='utf8') as inf:
+                stats = json.load(inf)
+        if best is None or elapsed<best[0]:
+            best = (elapsed, stats)
+
+    elapsed, stats = best
+    add_metric(ctx, 'e2e %s files/s' % (label), len(files)/elapsed, 'files/s')
+    add_metric(ctx, 'e2e %s MB/s' % (label), \
+        total_bytes/1000000/elapsed, 'MB/s')
+    for phase, t in stats['phase_sec'].items():
+        add_metric(ctx, 'e2e %s %s' % (label, phase), t, 's')
+
+# Times a function, returning the best time of ctx.repeat runs.
+def best_time(ctx, func):
+    best = None
+    for i in range(ctx.repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed<best:
+            best = elapsed
+    return best
+
+# Header parsing only (open, detect_and_decode_exe, choose a strategy).
+def bench_headers(ctx, files):
+    ectx = exehash.context()
+    def run():
+        for fn in files:
+            fctx = exehash.new_file_context(ectx, fn)
+            fctx.inf = open(fn, 'rb')
+            fctx.inf.seek(0, 2)
+            fctx.filesize = fctx.inf.tell()
+            exehash.analyze_stream(ectx, fctx, False)
+            fctx.inf.close()
+    add_metric(ctx, 'header files/s', len(files)/best_time(ctx, run), \
+        'files/s')
+
+# The hashing functions, on data in memory.
+def bench_hashers(ctx):
+    ectx = exehash.context()
+    data = random.Random(ctx.seed).randbytes(1024*1024)
+    def run_crc():
+        exehash.new_crcobj(ectx).update(data)
+    add_metric(ctx, 'crc32 MB/s', len(data)/1000000/best_time(ctx, run_crc), \
+        'MB/s')
+    for name in ('md5', 'sha256', 'sim'):
+        def run_digest():
+            exehash.new_digest_obj(name).update(data)
+        add_metric(ctx, '%s MB/s' % (name), \
+            len(data)/1000000/best_time(ctx, run_digest), 'MB/s')
+
+# Dictionary lookups, in a Python dict.
+def bench_dict_lookup(ctx):
+    ectx = exehash.context()
+    rng = random.Random(ctx.seed)
+    d = {}
+    for i in range(100000):
+        d[rng.randrange(1, 1<<32)] = 'FILE%d' % (i)
+    ectx.dicts.append(d)
+    keys = [rng.randrange(1, 1<<32) for i in range(100000)]
+    def run():
+        for crc in keys:
+            exehash.dict_lookup(ectx, crc)
+    add_metric(ctx, 'dict lookups/s', len(keys)/best_time(ctx, run), \
+        'lookups/s')
+
+# Higher is better, except for times.
+def is_regression(ctx, metric, base):
+    if metric['unit']=='s':
+        # Phase times are too noisy to be worth flagging, when they are
+        # tiny.
+        return metric['value'] > max(base['value']*(1+ctx.tolerance), 0.05)
+    return metric['value'] < base['value']*(1-ctx.tolerance)
+
+# Prints the results, compared to the baseline if there is one. Returns
+# the number of regressions.
+def report(ctx, baseline):
+    num_regressions = 0
+    for name, metric in ctx.metrics.items():
+        line = '%-28s %12.3f %-9s' % (name, metric['value'], metric['unit'])
+        if name in baseline and baseline[name]['value']>0:
+            base = baseline[name]
+            line += ' baseline %12.3f (%5.2fx)' % (base['value'], \
+                metric['value']/base['value'])
+            if is_regression(ctx, metric, base):
+                line += ' REGRESSION'
+                num_regressions += 1
+        print(line)
+    return num_regressions
+
+def read_baseline(ctx):
+    with open(ctx.baseline_filename, 'r', encoding='utf8') as inf:
+        x = json.load(inf)
+    if x['corpus']!={'seed': ctx.seed, 'max_size': ctx.max_size}:
+        print('Warning: Baseline was made with a different corpus')
+    return x['metrics']
+
+def save_baseline(ctx):
+    with open(ctx.save_baseline_filename, 'w', encoding='utf8') as outf:
+        json.dump({'corpus': {'seed': ctx.seed, 'max_size': ctx.max_size},
+            'metrics': ctx.metrics}, outf, indent=1)
+        outf.write('\n')
+
+def usage():
+    print("exehash_bench")
+    print("Benchmark Exehash on a synthetic corpus")
+    print("Usage: exehash_bench.py [options] corpusdir")
+    print("  Options:")
+    print("   --generate : Generate the corpus, if needed")
+    print("   --max-size <n> : Largest file size, e.g. 64K, 16M, 1G (def. 1M)")
+    print("   --seed <n> : Random seed for the corpus (default 1)")
+    print("   --repeat <n> : Run each test n times, and use the best (def. 3)")
+    print("   --baseline <file> : Compare to a saved baseline")
+    print("   --save-baseline <file> : Save the results as a baseline")
+    print("   --tolerance <pct> : Allowed slowdown vs. baseline (default 10)")
+
+def main():
+    ctx = context()
+
+    i = 1
+    while i<len(sys.argv):
+        if sys.argv[i][0]=='-':
+            if sys.argv[i]=='--generate':
+                ctx.opt_generate = True
+            elif sys.argv[i]=='--max-size':
+                i += 1
+                ctx.max_size = parse_size(sys.argv[i])
+            elif sys.argv[i]=='--seed':
+                i += 1
+                ctx.seed = int(sys.argv[i])
+            elif sys.argv[i]=='--repeat':
+                i += 1
+                ctx.repeat = int(sys.argv[i])
+            elif sys.argv[i]=='--baseline':
+                i += 1
+                ctx.baseline_filename = sys.argv[i]
+            elif sys.argv[i]=='--save-baseline':
+                i += 1
+                ctx.save_baseline_filename = sys.argv[i]
+            elif sys.argv[i]=='--tolerance':
+                i += 1
+                ctx.tolerance = float(sys.argv[i])/100.0
+            else:
+                print('Unrecognized option "%s"' % (sys.argv[i]))
+                return
+        else:
+            ctx.corpus_dir = sys.argv[i]
+        i += 1
+
+    if ctx.corpus_dir=='':
+        usage()
+        return
+
+    if ctx.opt_generate:
+        generate_corpus(ctx)
+
+    baseline = {}
+    if ctx.baseline_filename!='':
+        baseline = read_baseline(ctx)
+
+    files = read_corpus_files(ctx)
+    bench_end_to_end(ctx, 'default', [], files)
+    bench_end_to_end(ctx, '-a', ['-a'], files)
+    bench_end_to_end(ctx, '-s', ['-s'], files)
+    bench_headers(ctx, files)
+    bench_hashers(ctx)
+    bench_dict_lookup(ctx)
+
+    num_regressions = report(ctx, baseline)
+
+    if ctx.save_baseline_filename!='':
+        save_baseline(ctx)
+
+    if num_regressions>0:
+        print('%d regression(s)' % (num_regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,13 @@
 # Terms of use: MIT license. See COPYING.txt.
 
 import sys
+import struct
+import os
+import json
+import re
+import mmap
+import array
+import multiprocessing
 
 crc32_tab = [
     0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
@@ -112,6 +119,13 @@ class ea_segment:
 class global_context:
     def __init__(gctx):
         gctx.include_prefixes = False
+        gctx.recurse = False
+        gctx.json_output = False
+        gctx.num_jobs = 1
+        gctx.outfilename = ''
+        gctx.outdir = ''
+        gctx.sigdb = ea_sigdb()
+        gctx.summary = False
 
 class file_context:
     def __init__(ctx):
@@ -152,10 +166,14 @@ class file_context:
         ctx.cmpr_reloc_tbl_pos = ea_number()
         ctx.cmpr_reloc_tbl_size = ea_number()
         ctx.cmpr_reloc_tbl_nrelocs = ea_number()
+        # The decoded relocation table, if known: array('H') of
+        # (offset, segment) pairs, as in an MZ file.
+        ctx.relocs = None
 
         ctx.dest_len = 0
         ctx.skip_len = 0 # Meaningful if >1
         ctx.reported_exepack_size = 0
+        ctx.outfilename = '' # Set if the file was decompressed
 
 def getbyte(ctx, offset):
     if offset+1 > len(ctx.blob):
@@ -177,7 +195,41 @@ def gets16(ctx, offset):
 def ip_to_filepos(ctx, ip):
     return ctx.CS_pos_in_file.val + ip
 
+# Byte sequences with wildcards are searched for using regular
+# expressions, compiled once per (vals, wildcard).
+g_bseq_regex_cache = {}
+
+def get_bseq_regex(vals, wildcard):
+    key = (bytes(vals), wildcard)
+    if not (key in g_bseq_regex_cache):
+        pattern = b''
+        for v in vals:
+            if v == wildcard:
+                pattern += b'.'
+            else:
+                pattern += re.escape(bytes([v]))
+        g_bseq_regex_cache[key] = re.compile(pattern, re.DOTALL)
+    return g_bseq_regex_cache[key]
+
 def bseq_match(ctx, pos1, vals, wildcard):
+    if pos1+len(vals) > len(ctx.blob):
+        return False
+    if pos1 < 0:
+        return bseq_match_slow(ctx, pos1, vals, wildcard)
+    return get_bseq_regex(vals, wildcard).match(ctx.blob, pos1) is not None
+
+def bseq_exact(ctx, pos1, vals):
+    if pos1+len(vals) > len(ctx.blob):
+        return False
+    if pos1 < 0:
+        return bseq_exact_slow(ctx, pos1, vals)
+    return ctx.blob[pos1:pos1+len(vals)] == vals
+
+# The "slow" functions are the straightforward versions of the search
+# functions. They are used when a position is negative (which makes Python
+# index from the end of the file), to keep the results exactly the same.
+
+def bseq_match_slow(ctx, pos1, vals, wildcard):
     if pos1+len(vals) > len(ctx.blob):
         return False
 
@@ -189,7 +241,7 @@ def bseq_match(ctx, pos1, vals, wildcard):
 
     return True
 
-def bseq_exact(ctx, pos1, vals):
+def bseq_exact_slow(ctx, pos1, vals):
     if pos1+len(vals) > len(ctx.blob):
         return False
 
@@ -199,9 +251,7 @@ def bseq_exact(ctx, pos1, vals):
 
     return True
 
-# maxbytes is the number of starting positions to consider
-# (not the size of the 'haystack').
-def find_bseq_match(ctx, startpos, maxbytes, vals, wildcard):
+def find_bseq_match_slow(ctx, startpos, maxbytes, vals, wildcard):
     pos = startpos
 
     while pos < startpos+maxbytes:
@@ -224,9 +274,7 @@ def find_bseq_match(ctx, startpos, maxbytes, vals, wildcard):
 
     return False, 0
 
-# maxbytes is the number of starting positions to consider
-# (not the size of the 'haystack').
-def find_bseq_exact(ctx, startpos, maxbytes, vals):
+def find_bseq_exact_slow(ctx, startpos, maxbytes, vals):
     pos = startpos
 
     while pos < startpos+maxbytes:
@@ -247,12 +295,57 @@ def find_bseq_exact(ctx, startpos, maxbytes, vals):
 
     return False, 0
 
+# Returns the end of the region to search, for find_bseq_*(): A match must
+# start before startpos+maxbytes, and end by the end of the file.
+def bseq_search_end(ctx, startpos, maxbytes, vals):
+    return min(startpos+maxbytes-1+len(vals), ctx.file_size.val)
+
+# maxbytes is the number of starting positions to consider
+# (not the size of the 'haystack').
+def find_bseq_match(ctx, startpos, maxbytes, vals, wildcard):
+    if startpos < 0:
+        return find_bseq_match_slow(ctx, startpos, maxbytes, vals, wildcard)
+    if maxbytes < 1 or startpos+len(vals) > ctx.file_size.val:
+        return False, 0
+
+    m = get_bseq_regex(vals, wildcard).search(ctx.blob, startpos, \
+        bseq_search_end(ctx, startpos, maxbytes, vals))
+    if m is None:
+        return False, 0
+    return True, m.start()
+
+# maxbytes is the number of starting positions to consider
+# (not the size of the 'haystack').
+def find_bseq_exact(ctx, startpos, maxbytes, vals):
+    if startpos < 0:
+        return find_bseq_exact_slow(ctx, startpos, maxbytes, vals)
+    if maxbytes < 1 or startpos+len(vals) > ctx.file_size.val:
+        return False, 0
+
+    pos = ctx.blob.find(vals, startpos, \
+        bseq_search_end(ctx, startpos, maxbytes, vals))
+    if pos < 0:
+        return False, 0
+    return True, pos
+
+# The file is memory-mapped, so that only the parts we look at are read.
+# (ctx.blob is only indexed, sliced, and searched, which work the same for
+# an mmap as for a bytearray.) Files that can't be mapped, such as empty
+# files, are read into memory instead.
 def ea_open_file(ctx):
-    inf = open(ctx.infilename, "rb")
-    ctx.blob = bytearray(inf.read())
-    inf.close()
+    ctx.blob = None
+    with open(ctx.infilename, "rb") as inf:
+        try:
+            ctx.blob = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            ctx.blob = bytearray(inf.read())
     ctx.file_size.set(len(ctx.blob))
 
+def ea_close_file(ctx):
+    if isinstance(ctx.blob, mmap.mmap):
+        ctx.blob.close()
+    ctx.blob = None
+
 def ea_read_exe(ctx):
     ctx.executable_fmt.set('EXE')
     e_cblp = getu16(ctx, 2)
@@ -365,6 +458,195 @@ g_fingerprints = {
     0x5a159410: {'ds':283, 'sc':'EXEPATCK283', 'cb':'EXEPATCK'},
     0x848c6688: {'ds':283, 'sc':'Fifield', 'cb':"D. Fifield's exepack"} }
 
+# Byte patterns for decoders whose fingerprint is unknown, in priority
+# order. The pattern is searched for at decoder pos + 'start', for 'range'
+# positions. "??" is a wildcard. The word at match pos + 'rp' is the
+# (CS-relative) position of the compressed relocation table.
+g_decoder_patterns = [
+    {'pat':'0e 1f 8b 1e 04 00 fc 33 d2 ad', 'start':50, 'range':120, 'rp':-2},
+    {'pat':'0e 1f fc 8b d3 ad 91 e3 14 ad', 'start':50, 'range':120, 'rp':-2,
+        'cb':'EXPAKFIX'} ]
+
+class ea_decoder_pattern:
+    def __init__(self, x):
+        tokens = x['pat'].split()
+        literals = set([int(t, 16) for t in tokens if t!='??'])
+        # Choose a byte value to stand for the wildcard.
+        self.wildcard = min(set(range(256)) - literals)
+        self.vals = bytes([self.wildcard if t=='??' else int(t, 16) \
+            for t in tokens])
+        self.start = x['start']
+        self.range = x['range']
+        self.rp = x['rp']
+        self.sc = x.get('sc')
+        self.cb = x.get('cb')
+
+        # The anchor is the longest run of non-wildcard bytes. Candidate
+        # positions are found by searching for the anchors.
+        self.anchor = b''
+        self.anchor_offset = 0
+        i = 0
+        while i<len(tokens):
+            k = i
+            while k<len(tokens) and tokens[k]!='??':
+                k += 1
+            if k-i > len(self.anchor):
+                self.anchor = self.vals[i:k]
+                self.anchor_offset = i
+            i = k+1
+        if len(self.anchor)==0:
+            raise ValueError('Pattern has no fixed bytes')
+
+# The decoder signature database: the built-in fingerprints and patterns,
+# plus any loaded with --sigdb. If there is more than one entry for a
+# fingerprint, the first one wins. Patterns are tried in order.
+class ea_sigdb:
+    def __init__(self):
+        self.fingerprints = {}
+        self.patterns = []
+        self.add_fingerprints(g_fingerprints)
+        self.add_patterns(g_decoder_patterns)
+        self.automaton = None
+
+    def add_fingerprints(self, d):
+        for crc, x in d.items():
+            if not (crc in self.fingerprints):
+                self.fingerprints[crc] = x
+
+    def add_patterns(self, lst):
+        for x in lst:
+            self.patterns.append(ea_decoder_pattern(x))
+        self.automaton = None
+
+    # Build an Aho-Corasick automaton for the anchors, so that the decoder
+    # can be searched for all of them in one pass.
+    def build_automaton(self):
+        goto = [{}]
+        fail = [0]
+        out = [[]]
+        for k in range(len(self.patterns)):
+            anchor = self.patterns[k].anchor
+            state = 0
+            for c in anchor:
+                if not (c in goto[state]):
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                    goto[state][c] = len(goto)-1
+                state = goto[state][c]
+            out[state].append(k)
+
+        queue = list(goto[0].values())
+        while len(queue)>0:
+            r = queue.pop(0)
+            for c, u in goto[r].items():
+                queue.append(u)
+                f = fail[r]
+                while f!=0 and not (c in goto[f]):
+                    f = fail[f]
+                if r!=0 and (c in goto[f]):
+                    fail[u] = goto[f][c]
+                out[u] = out[u] + out[fail[u]]
+
+        self.automaton = (goto, fail, out)
+
+# Reads a signature database file (JSON), and adds it to gctx.sigdb.
+# The format is like g_fingerprints and g_decoder_patterns:
+#  {"fingerprints": {"77dc4e4a": {"ds":258, "sc":"...", "cb":"..."}, ...},
+#   "patterns": [{"pat":"0e 1f ?? ...", "start":50, "range":120, "rp":-2,
+#     "sc":"...", "cb":"..."}, ...]}
+def ea_load_sigdb(gctx, filename):
+    try:
+        with open(filename, 'r', encoding='utf8') as inf:
+            x = json.load(inf)
+        fingerprints = {}
+        for crc, v in x.get('fingerprints', {}).items():
+            ea_check_sigdb_entry(v, ['ds'])
+            fingerprints[int(crc, 16)] = v
+        for v in x.get('patterns', []):
+            ea_check_sigdb_entry(v, ['start', 'range', 'rp'])
+            if not isinstance(v.get('pat'), str):
+                raise ValueError()
+        gctx.sigdb.add_fingerprints(fingerprints)
+        gctx.sigdb.add_patterns(x.get('patterns', []))
+    except (json.JSONDecodeError, KeyError, ValueError, TypeError, \
+        AttributeError):
+        raise Exception('Bad signature database: ' + filename)
+
+# Checks that a --sigdb entry has the given integer fields, and that its
+# optional "sc" and "cb" fields, if present, are strings.
+def ea_check_sigdb_entry(v, int_fields):
+    if not isinstance(v, dict):
+        raise ValueError()
+    for f in int_fields:
+        if not (isinstance(v.get(f), int) and not isinstance(v[f], bool)):
+            raise ValueError()
+    for f in ('sc', 'cb'):
+        if (f in v) and not isinstance(v[f], str):
+            raise ValueError()
+
+# Writes the built-in signature database, in the --sigdb format.
+def ea_dump_sigdb(filename):
+    x = {'fingerprints': {}, 'patterns': g_decoder_patterns}
+    for crc, v in g_fingerprints.items():
+        x['fingerprints']['%08x' % (crc)] = v
+    with open(filename, 'w', encoding='utf8') as outf:
+        json.dump(x, outf, indent=1)
+        outf.write('\n')
+
+# Search for the decoder patterns, relative to decoder position pos.
+# Returns (pattern, match pos) for the first pattern that matches (at its
+# first matching position), or (None, 0).
+def ea_find_decoder_pattern(ctx, pos):
+    db = ctx.sigdb
+    if len(db.patterns)==0:
+        return None, 0
+
+    lo = pos + min([p.start for p in db.patterns])
+    if lo < 0:
+        # Rare. Keep the same behavior as find_bseq_match(), for negative
+        # positions.
+        for p in db.patterns:
+            ok, foundpos = find_bseq_match(ctx, pos+p.start, p.range, \
+                p.vals, p.wildcard)
+            if ok:
+                return p, foundpos
+        return None, 0
+
+    if db.automaton is None:
+        db.build_automaton()
+    goto, fail, out = db.automaton
+
+    best = None # (pattern number, match pos)
+
+    def consider(k, foundpos):
+        nonlocal best
+        p = db.patterns[k]
+        if foundpos < pos+p.start or foundpos >= pos+p.start+p.range:
+            return
+        if foundpos+len(p.vals) > ctx.file_size.val:
+            return
+        if best is not None and (k, foundpos) >= best:
+            return
+        if bseq_match(ctx, foundpos, p.vals, p.wildcard):
+            best = (k, foundpos)
+
+    hi = max([pos+p.start+p.range-1+len(p.vals) for p in db.patterns])
+    hi = min(hi, ctx.file_size.val)
+    state = 0
+    for i in range(lo, hi):
+        c = ctx.blob[i]
+        while state!=0 and not (c in goto[state]):
+            state = fail[state]
+        state = goto[state].get(c, 0)
+        for k in out[state]:
+            p = db.patterns[k]
+            consider(k, i+1-len(p.anchor)-p.anchor_offset)
+
+    if best is None:
+        return None, 0
+    return db.patterns[best[0]], best[1]
+
 # Decode the main part of the EXEPACK decoder.
 # Requires ctx.decoder.pos to be set.
 def ea_decode_decoder(ctx):
@@ -379,8 +661,8 @@ def ea_decode_decoder(ctx):
     pos = ctx.decoder.pos.val
     pos_of_reloc_ptr = 0
 
-    if ctx.crc_fingerprint.val in g_fingerprints:
-        x = g_fingerprints[ctx.crc_fingerprint.val]
+    if ctx.crc_fingerprint.val in ctx.sigdb.fingerprints:
+        x = ctx.sigdb.fingerprints[ctx.crc_fingerprint.val]
         ctx.decoder_size.set(x['ds'])
         ctx.cmpr_reloc_tbl_pos.set(pos+ctx.decoder_size.val)
         if 'sc' in x:
@@ -390,20 +672,14 @@ def ea_decode_decoder(ctx):
         found = True
 
     if not found:
-        ok, foundpos = find_bseq_exact(ctx, pos+50, 120,
-        b'\x0e\x1f\x8b\x1e\x04\x00\xfc\x33\xd2\xad')
-        if ok:
-            pos_of_reloc_ptr = foundpos-2
-            found = True
-
-    if not found:
-        ok, foundpos = find_bseq_exact(ctx, pos+50, 120,
-        b'\x0e\x1f\xfc\x8b\xd3\xad\x91\xe3\x14\xad')
-        if ok:
-            # TODO: Decide how to classify these decoders.
-            #ctx.decoder.segclass.set("EXPAKFIX")
-            ctx.createdby.set("EXPAKFIX")
-            pos_of_reloc_ptr = foundpos-2
+        p, foundpos = ea_find_decoder_pattern(ctx, pos)
+        if p is not None:
+            # TODO: Decide how to classify the EXPAKFIX decoders.
+            if p.sc is not None:
+                ctx.decoder.segclass.set(p.sc)
+            if p.cb is not None:
+                ctx.createdby.set(p.cb)
+            pos_of_reloc_ptr = foundpos+p.rp
             found = True
 
     if found and (pos_of_reloc_ptr>0):
@@ -451,6 +727,46 @@ def ea_find_num_relocs(ctx):
     n = (ctx.cmpr_reloc_tbl_size.val - 32) // 2
     ctx.cmpr_reloc_tbl_nrelocs.set(n)
 
+    # But decode the table, to get the exact number.
+    ctx.relocs = ea_decode_relocs(ctx)
+    if ctx.relocs is not None:
+        ctx.cmpr_reloc_tbl_nrelocs.set(len(ctx.relocs)//2)
+
+# Decode the compressed relocation table: for each of the 16 segments
+# 0x0000, 0x1000, ..., 0xf000, a count, followed by that many offsets.
+# Returns an array('H') of (offset, segment) pairs, or None if the table
+# runs past the end of the file.
+def ea_decode_relocs(ctx):
+    offsets = array.array('H')
+    segments = array.array('H')
+    pos = ctx.cmpr_reloc_tbl_pos.val
+    if pos < 0:
+        return None
+    for i in range(16):
+        if pos+2 > ctx.file_size.val:
+            return None
+        count = getu16(ctx, pos)
+        pos += 2
+        if pos+2*count > ctx.file_size.val:
+            return None
+        offsets.frombytes(ctx.blob[pos : pos+2*count])
+        segments.extend(array.array('H', [i*0x1000]) * count)
+        pos += 2*count
+    if sys.byteorder=='big':
+        offsets.byteswap()
+
+    relocs = array.array('H', bytes(4*len(offsets)))
+    relocs[0::2] = offsets
+    relocs[1::2] = segments
+    return relocs
+
+# Returns the relocation table in MZ format (4 bytes per entry).
+def ea_relocs_to_mz_table(relocs):
+    if sys.byteorder=='big':
+        relocs = array.array('H', relocs)
+        relocs.byteswap()
+    return relocs.tobytes()
+
 def ea_deduce_settings1(ctx):
     if (not ctx.errmsg_pos.val_known) and \
         ctx.epilogpos.val_known:
@@ -496,6 +812,125 @@ def ea_check_errmsg(ctx):
     if not ok:
         ctx.tags.append('modified error message')
 
+# Decompress the code image. Returns a bytearray, or None if the data is
+# bad (ctx.errmsg is set).
+# The data is decompressed backwards, starting from the end. As in the real
+# decoder, it's done in place: the buffer starts out as a copy of the
+# compressed data, and any part not overwritten is left as is.
+def ea_decompress_data(ctx):
+    cmpr_len = ctx.cmpr_data_len.val
+    uncmpr_len = ctx.uncmpr_data_len.val
+    if ctx.end_of_cmpr_data.val > ctx.file_size.val or cmpr_len<1:
+        ctx.errmsg = 'Bad compressed data'
+        return None
+
+    buf = bytearray(max(cmpr_len, uncmpr_len))
+    buf[0:cmpr_len] = ctx.blob[ctx.start_of_cmpr_data.val : \
+        ctx.end_of_cmpr_data.val]
+
+    # Skip up to 16 bytes of 0xff padding.
+    src = cmpr_len
+    for i in range(16):
+        if src<1 or buf[src-1]!=0xff:
+            break
+        src -= 1
+
+    dst = uncmpr_len
+    while True:
+        if src<3:
+            ctx.errmsg = 'Bad compressed data'
+            return None
+        cmd = buf[src-1]
+        length = buf[src-3] + 256*buf[src-2]
+        src -= 3
+
+        if (cmd & 0xfe)==0xb0: # fill
+            if src<1 or dst<length:
+                ctx.errmsg = 'Bad compressed data'
+                return None
+            fillbyte = buf[src-1]
+            src -= 1
+            buf[dst-length : dst] = bytes([fillbyte]) * length
+        elif (cmd & 0xfe)==0xb2: # copy
+            if src<length or dst<length:
+                ctx.errmsg = 'Bad compressed data'
+                return None
+            buf[dst-length : dst] = buf[src-length : src]
+            src -= length
+        else:
+            ctx.errmsg = 'Bad compressed data'
+            return None
+        dst -= length
+
+        if cmd & 0x01:
+            break
+
+    return buf[0:uncmpr_len]
+
+# Returns the decompressed file, as a bytearray, or None if it can't be
+# decompressed (ctx.errmsg is set).
+def ea_decompress(ctx):
+    if ctx.is_exepack.is_false_or_unk() or \
+        (not ctx.cmpr_reloc_tbl_pos.val_known):
+        if ctx.errmsg=='':
+            ctx.errmsg = "Can't decompress"
+        return None
+    if ctx.relocs is None:
+        ctx.errmsg = 'Bad relocation table'
+        return None
+
+    code = ea_decompress_data(ctx)
+    if code is None:
+        return None
+
+    num_relocs = len(ctx.relocs)//2
+
+    # The real entry point, and stack, are in the EXEPACK header.
+    real_ip = getu16(ctx, ctx.header_pos.val)
+    real_cs = getu16(ctx, ctx.header_pos.val + 2)
+    real_sp = getu16(ctx, ctx.header_pos.val + 8)
+    real_ss = getu16(ctx, ctx.header_pos.val + 10)
+
+    # Keep the total memory requirement the same.
+    old_minalloc = getu16(ctx, 10)
+    maxalloc = getu16(ctx, 12)
+    old_image_paras = (ctx.codeend.val - ctx.codestart.val + 15)//16
+    new_image_paras = (len(code) + 15)//16
+    minalloc = old_image_paras + old_minalloc - new_image_paras
+    minalloc = min(max(minalloc, 0), 0xffff)
+    if maxalloc<minalloc:
+        maxalloc = minalloc
+
+    hdr_paras = (28 + 4*num_relocs + 15)//16
+    hdr = bytearray(16*hdr_paras)
+    codeend = len(hdr) + len(code)
+    hdr[0:28] = b'MZ' + struct.pack("<HHHHHHHHHHHHH", codeend%512, \
+        (codeend+511)//512, num_relocs, hdr_paras, minalloc, maxalloc, \
+        real_ss, real_sp, 0, real_ip, real_cs, 28, 0)
+    hdr[28 : 28+4*num_relocs] = ea_relocs_to_mz_table(ctx.relocs)
+
+    return hdr + code + ctx.blob[ctx.codeend.val : ctx.file_size.val]
+
+def ea_write_decompressed(gctx, ctx):
+    if gctx.outfilename!='':
+        outfilename = gctx.outfilename
+    else:
+        outfilename = os.path.join(gctx.outdir, \
+            os.path.basename(ctx.infilename))
+
+    data = ea_decompress(ctx)
+    if data is None:
+        return
+    # Never overwrite an existing file. This also protects the input file,
+    # and, with --outdir, files with the same name from other directories.
+    try:
+        outf = open(outfilename, 'xb')
+    except FileExistsError:
+        raise Exception('Output file exists: ' + outfilename)
+    with outf:
+        outf.write(data)
+    ctx.outfilename = outfilename
+
 def report_exe_specific(ctx):
     print(ctx.p_INFO+'host code start:', ctx.codestart.getpr())
     print(ctx.p_INFO+'host code end:', ctx.codeend.getpr())
@@ -584,57 +1019,284 @@ def ea_report(ctx):
     if ctx.is_exepack.is_true():
         report_exepack_specific(ctx)
 
+# Returns the analysis results as a dict, suitable for JSON: one item per
+# file_context field. Unknown values are None.
+def ea_to_dict(ctx):
+    d = {'file': ctx.infilename}
+    for name, x in vars(ctx).items():
+        if name in ('infilename', 'blob', 'include_prefixes', 'sigdb', \
+            'relocs') or \
+            name.startswith('p_'):
+            continue
+        if isinstance(x, ea_property):
+            d[name] = x.val if x.val_known else None
+        elif isinstance(x, ea_segment):
+            d[name] = {'segclass': x.segclass.val if x.segclass.val_known \
+                else None, 'pos': x.pos.val if x.pos.val_known else None}
+        else:
+            d[name] = x
+    return d
+
 def usage():
-    print('usage: exepacka.py [options] <infile>')
+    print('usage: exepacka.py [options] <infile> [<infile2>...]')
     print(' options: -p  Print item importance')
-
-def main_onefile(gctx, filename):
+    print('          -r  Recurse into directories')
+    print('          -j <n>  Use n worker processes (0 = one per CPU)')
+    print('          --json  Print one JSON object per file, one per line')
+    print('          -o <outfile>  Decompress to this file (one input file only)')
+    print('          --outdir <dir>  Decompress each file into this directory')
+    print('          --sigdb <file>  Load additional decoder signatures')
+    print('          --summary  Print only a summary of all the files')
+    print('          --dump-sigdb <file>  Write the built-in signatures, and exit')
+
+# Analyze a file. Does not print anything.
+# Returns the file_context, minus the file contents.
+def ea_analyze(gctx, filename):
     ctx = file_context()
     ctx.include_prefixes = gctx.include_prefixes
     ctx.infilename = filename
+    ctx.sigdb = gctx.sigdb
+    ctx.blob = None
+
+    try:
+        ea_open_file(ctx)
+        if ctx.errmsg=='':
+            ea_read_main(ctx)
+        if ctx.errmsg=='':
+            ea_decode_overlay(ctx)
+        if ctx.errmsg=='':
+            ea_check_cdata2(ctx)
+        if ctx.errmsg=='':
+            ea_decode_header(ctx)
+        if ctx.errmsg=='':
+            ea_decode_epilog(ctx)
+        if ctx.errmsg=='':
+            ea_decode_decoder(ctx)
+
+        ea_deduce_settings1(ctx)
+
+        if ctx.errmsg=='':
+            ea_check_errmsg(ctx)
+
+        if ctx.errmsg=='' and (gctx.outfilename!='' or gctx.outdir!=''):
+            ea_write_decompressed(gctx, ctx)
+    except Exception as e:
+        if ctx.errmsg=='':
+            ctx.errmsg = str(e)
+    finally:
+        ea_close_file(ctx)
+        # Don't send the database back to the main process (with -j).
+        ctx.sigdb = None
+
+    return ctx
+
+def main_report(gctx, ctx):
+    if gctx.json_output:
+        print(json.dumps(ea_to_dict(ctx)))
+        return
 
     print('file:', ctx.infilename)
-    ea_open_file(ctx)
-    if ctx.errmsg=='':
-        ea_read_main(ctx)
-    if ctx.errmsg=='':
-        ea_decode_overlay(ctx)
-    if ctx.errmsg=='':
-        ea_check_cdata2(ctx)
-    if ctx.errmsg=='':
-        ea_decode_header(ctx)
-    if ctx.errmsg=='':
-        ea_decode_epilog(ctx)
-    if ctx.errmsg=='':
-        ea_decode_decoder(ctx)
-
-    ea_deduce_settings1(ctx)
-
-    if ctx.errmsg=='':
-        ea_check_errmsg(ctx)
     ea_report(ctx)
+    if ctx.outfilename!='':
+        print('decompressed to:', ctx.outfilename)
     if ctx.errmsg!='':
         print('Error:', ctx.errmsg)
 
+# For --summary: Counts of each value of some fields, and histograms of
+# others, for all the files processed. Memory use doesn't depend on the
+# number of files: at most g_summary_max_values different values are
+# counted for each field, and a few example filenames are kept for each tag.
+g_summary_max_values = 1000
+g_summary_max_examples = 5
+
+class ea_summary:
+    # (label, function that returns the value)
+    count_fields = [
+        ('executable format', lambda ctx: ctx.executable_fmt.getpr()),
+        ('EXEPACK detected', lambda ctx: ctx.is_exepack.getpr_yesno()),
+        ('EXEPACK header size', lambda ctx: ctx.header_size.getpr()),
+        ('decoder size', lambda ctx: ctx.decoder_size.getpr()),
+        ('decoder class', lambda ctx: ctx.decoder.segclass.getpr()),
+        ('decoder fingerprint', lambda ctx: '0x%08x' % \
+            (ctx.crc_fingerprint.val) if ctx.crc_fingerprint.val_known \
+            else '?'),
+        ('created by', lambda ctx: ctx.createdby.getpr()),
+        ('error', lambda ctx: ctx.errmsg if ctx.errmsg!='' else '(none)') ]
+    # Histograms of numeric fields, with power-of-2 buckets
+    hist_fields = [
+        ('file size', lambda ctx: ctx.file_size),
+        ('overlay size', lambda ctx: ctx.overlay_size),
+        ('cmpr data len', lambda ctx: ctx.cmpr_data_len),
+        ('uncmpr data len', lambda ctx: ctx.uncmpr_data_len),
+        ('cmpr reloc tbl num relocs', lambda ctx: ctx.cmpr_reloc_tbl_nrelocs) ]
+
+    def __init__(self):
+        self.num_files = 0
+        self.counts = {}
+        for label, f in self.count_fields:
+            self.counts[label] = {}
+        self.hists = {}
+        for label, f in self.hist_fields:
+            self.hists[label] = {}
+        self.tag_counts = {}
+        self.tag_examples = {}
+
+    def count(self, d, val):
+        if (val in d) or len(d)<g_summary_max_values:
+            d[val] = d.get(val, 0) + 1
+        else:
+            d['(other)'] = d.get('(other)', 0) + 1
+
+    def add(self, ctx):
+        self.num_files += 1
+        for label, f in self.count_fields:
+            self.count(self.counts[label], str(f(ctx)))
+        for label, f in self.hist_fields:
+            x = f(ctx)
+            if x.val_known and x.val>0:
+                # Bucket n holds values from 2**(n-1) to 2**n - 1.
+                bucket = x.val.bit_length()
+            else:
+                bucket = 0
+            self.hists[label][bucket] = self.hists[label].get(bucket, 0) + 1
+        for tag in ctx.tags:
+            self.count(self.tag_counts, tag)
+            examples = self.tag_examples.setdefault(tag, [])
+            if len(examples)<g_summary_max_examples:
+                examples.append(ctx.infilename)
+
+    def as_dict(self):
+        d = {'files': self.num_files, 'counts': self.counts,
+            'histograms': {}, 'tags': self.tag_counts,
+            'tag_examples': self.tag_examples}
+        for label in self.hists:
+            d['histograms'][label] = [{'max': (1 << bucket) - 1, \
+                'files': n} for bucket, n in sorted(self.hists[label].items())]
+        return d
+
+    def report(self, gctx):
+        if gctx.json_output:
+            print(json.dumps({'summary': self.as_dict()}))
+            return
+
+        print('files:', self.num_files)
+        for label in self.counts:
+            print()
+            print(label+':')
+            for val, n in sorted(self.counts[label].items(), \
+                key=lambda x: (-x[1], x[0])):
+                print('  %8d  %s' % (n, val))
+        for label in self.hists:
+            print()
+            print(label+':')
+            for bucket, n in sorted(self.hists[label].items()):
+                if bucket==0:
+                    rangestr = '0 or ?'
+                else:
+                    rangestr = '%d-%d' % (1 << (bucket-1), (1 << bucket)-1)
+                print('  %8d  %s' % (n, rangestr))
+        print()
+        print('tags:')
+        for tag, n in sorted(self.tag_counts.items(), \
+            key=lambda x: (-x[1], x[0])):
+            print('  %8d  %s' % (n, tag))
+            for fn in self.tag_examples.get(tag, []):
+                print('            e.g. %s' % (fn))
+
+g_worker_gctx = None
+
+def worker_init(gctx):
+    global g_worker_gctx
+    g_worker_gctx = gctx
+
+def worker_analyze(filename):
+    return ea_analyze(g_worker_gctx, filename)
+
+# Yields the names of the files to process. Directories (with -r) are
+# walked in sorted order.
+def expand_filenames(gctx, names):
+    for fn in names:
+        if gctx.recurse and os.path.isdir(fn):
+            for dirpath, dirnames, filenames in os.walk(fn):
+                dirnames.sort()
+                for x in sorted(filenames):
+                    yield os.path.join(dirpath, x)
+        else:
+            yield fn
+
 def main():
     gctx = global_context()
-    xcount = 0
-    for i in range(1, len(sys.argv)):
+    filenames = []
+
+    i = 1
+    while i<len(sys.argv):
         arg = sys.argv[i]
         if arg[0:1]=='-':
             if arg=='-p':
                 gctx.include_prefixes = True
-            continue
-        xcount += 1
+            elif arg=='-r':
+                gctx.recurse = True
+            elif arg=='--json':
+                gctx.json_output = True
+            elif arg=='-o':
+                i += 1
+                gctx.outfilename = sys.argv[i]
+            elif arg=='--outdir':
+                i += 1
+                gctx.outdir = sys.argv[i]
+            elif arg=='--summary':
+                gctx.summary = True
+            elif arg=='--sigdb':
+                i += 1
+                ea_load_sigdb(gctx, sys.argv[i])
+            elif arg=='--dump-sigdb':
+                i += 1
+                ea_dump_sigdb(sys.argv[i])
+                return
+            elif arg=='-j':
+                i += 1
+                gctx.num_jobs = int(sys.argv[i])
+                if gctx.num_jobs<1:
+                    gctx.num_jobs = os.cpu_count() or 1
+        else:
+            filenames.append(arg)
+        i += 1
 
-    if xcount!=1:
+    if len(filenames)<1:
         usage()
         return
 
-    # Currently, we only support one file, but that may change at
-    # some point.
-    for i in range(1, len(sys.argv)):
-        if sys.argv[i][0]!='-':
-            main_onefile(gctx, sys.argv[i])
+    if gctx.outfilename!='' and (len(filenames)>1 or gctx.recurse):
+        print('-o can only be used with one input file; use --outdir')
+        return
+
+    names = expand_filenames(gctx, filenames)
+    if gctx.num_jobs>1:
+        with multiprocessing.Pool(gctx.num_jobs, worker_init, \
+            (gctx,)) as pool:
+            main_process_results(gctx, pool.imap(worker_analyze, names, 8))
+    else:
+        main_process_results(gctx, \
+            (ea_analyze(gctx, fn) for fn in names))
+
+# Report (or, with --summary, count) each analyzed file, in order.
+def main_process_results(gctx, results):
+    summary = None
+    if gctx.summary:
+        summary = ea_summary()
+
+    first = True
+    for ctx in results:
+        if summary is not None:
+            summary.add(ctx)
+            continue
+        if not first and not gctx.json_output:
+            print()
+        first = False
+        main_report(gctx, ctx)
+
+    if summary is not None:
+        summary.report(gctx)
 
-main()
+if __name__ == '__main__':
+    main()